@@ -1,22 +1,179 @@
 # Short script to remove compression from Hajimari no Kiseki packagers.  
-# Output goes into the decompressed_output folder.
+# Output goes into the decompressed_output folder.  A folder or a wildcard (e.g. "*.pkg") can be given instead
+# of a single package, to decompress many packages in parallel.
+#
+# Requires my fork of unpackpkg.py, pkg_compression.py and stage_stats.py, put in the same directory
+#
 # GitHub eArmada8/misc_kiseki
 
-import sys, os, shutil, struct
-from unpackpkg import * # compression libraries
+import sys, os, shutil, struct, io, glob, time
+from pkg_compression import * # Optional compression of the XML in the output, and the decompressors of unpackpkg.py
+import stage_stats
+from stage_stats import * # Optional --stats instrumentation
+
+def read_pkg_entry (f, file_entry):
+    if stage_stats.stage_totals is None: # Stats disabled, skip the per-entry bookkeeping
+        return(read_pkg_entry_data(f, file_entry))
+    stage_name = 'decompress' if file_entry[3] & 29 else 'read'
+    with stage(stage_name):
+        data = read_pkg_entry_data(f, file_entry)
+    count(stage_name, entries = 1, bytes_read = file_entry[1], bytes_written = len(data))
+    return(data)
+
+def read_pkg_entry_data (f, file_entry):
+    f.seek(file_entry[0])
+    if file_entry[3] & 2:
+        # This is the crc32 of the file, but we don't handle this yet
+        f.seek(4, io.SEEK_CUR)
+    if file_entry[3] & 4:
+        return(uncompress_lz4(f, file_entry[2], file_entry[1]))
+    elif file_entry[3] & 24:
+        get_unpackpkg() # Loads zstandard, if installed
+        if "zstandard" in sys.modules:
+            return(uncompress_zstd(f, file_entry[2], file_entry[1]))
+        else:
+            raise Exception("File could not be decompressed because zstandard module is not installed")
+    elif file_entry[3] & 1:
+        return(uncompress_nislzss(f, file_entry[2], file_entry[1]))
+    else:
+        return(f.read(file_entry[2]))
+
+# Writes the original header, then streams each decompressed entry straight into the output and patches the
+# header entries at the end.  Only one entry is held in memory at a time.  XML entries can be compressed again
+# with compress_xml (see pkg_compression.py), as the game reads them at load.
+def decompress_pkg (pkg_filename, new_pkg_filename, compress_xml = 'none'):
+    with open(pkg_filename, 'rb') as f:
+        f.seek(4)
+        package_file_entries = []
+        total_file_entries, = struct.unpack("<I", f.read(4))
+        for file_entry_name, file_entry_uncompressed_size, file_entry_compressed_size, file_entry_offset,\
+                file_entry_flags in struct.iter_unpack("<64sIIII", f.read(total_file_entries * 80)):
+            package_file_entries.append([file_entry_offset, file_entry_compressed_size, file_entry_uncompressed_size, file_entry_flags, file_entry_name])
+
+        # The original header is copied as is, and only the size / offset / flag fields are patched later
+        archive_start_offset = package_file_entries[0][0] if len(package_file_entries) > 0 else 8 + total_file_entries * 80
+        f.seek(0)
+        patched_header = bytearray(f.read(archive_start_offset))
+
+        # Written to a temporary file first, so a failed run never leaves a partial package behind
+        f_out = open(new_pkg_filename + '.tmp', 'wb')
+        try:
+            with f_out:
+                f_out.write(patched_header)
+                current_offset = archive_start_offset
+                for file_entry_number in range(len(package_file_entries)):
+                    output_data = read_pkg_entry(f, package_file_entries[file_entry_number])
+                    uncompressed_size, output_flags = len(output_data), 0
+                    if compress_xml != 'none' and b'xml' in package_file_entries[file_entry_number][4]:
+                        output_data, output_flags = compress_entry(output_data, compress_xml, package_file_entries[file_entry_number][3])
+                    offset_location = (file_entry_number+1)*80-8
+                    patched_header[offset_location:offset_location+16] = struct.pack("<4I", uncompressed_size, len(output_data), current_offset, output_flags)
+                    with stage('write'):
+                        f_out.write(output_data)
+                    count('write', entries = 1, bytes_written = len(output_data))
+                    current_offset = current_offset + len(output_data)
+                f_out.seek(0)
+                f_out.write(patched_header)
+        except Exception:
+            os.remove(new_pkg_filename + '.tmp')
+            raise
+    os.replace(new_pkg_filename + '.tmp', new_pkg_filename)
+
+# The decompressed size is known from the TOC, so an existing output can be checked without decompressing
+def get_decompressed_size (pkg_filename):
+    with open(pkg_filename, 'rb') as f:
+        f.seek(4)
+        total_file_entries, = struct.unpack("<I", f.read(4))
+        file_entries = list(struct.iter_unpack("<64sIIII", f.read(total_file_entries * 80)))
+    if len(file_entries) == 0:
+        return(8 + total_file_entries * 80)
+    return(file_entries[0][3] + sum([x[1] for x in file_entries]))
+
+# With compress_xml the output size is not known in advance, so only the modification time is compared
+def is_up_to_date (pkg_filename, new_pkg_filename, compress_xml = 'none'):
+    if not os.path.exists(new_pkg_filename):
+        return(False)
+    try:
+        return(os.path.getmtime(new_pkg_filename) >= os.path.getmtime(pkg_filename)\
+            and (compress_xml != 'none' or os.path.getsize(new_pkg_filename) == get_decompressed_size(pkg_filename)))
+    except (OSError, struct.error):
+        return(False)
+
+# Worker for batch mode, returns [package, bytes read, bytes written, error message or None]
+def decompress_pkg_job (filenames):
+    pkg_filename, new_pkg_filename, compress_xml = filenames
+    try:
+        decompress_pkg(pkg_filename, new_pkg_filename, compress_xml)
+        return([pkg_filename, os.path.getsize(pkg_filename), os.path.getsize(new_pkg_filename), None])
+    except Exception as e:
+        return([pkg_filename, 0, 0, "{0}: {1}".format(type(e).__name__, e)])
+
+def decompress_pkgs (pkg_filenames, output_folder = 'decompressed_output', jobs = 0, force = False, compress_xml = 'none'):
+    import concurrent.futures
+    if not os.path.exists(output_folder):
+        os.mkdir(output_folder)
+    start_time = time.perf_counter()
+    pending = []
+    skipped = 0
+    for pkg_filename in pkg_filenames:
+        new_pkg_filename = os.path.join(output_folder, os.path.basename(pkg_filename))
+        if force == False and is_up_to_date(pkg_filename, new_pkg_filename, compress_xml):
+            skipped += 1
+        else:
+            pending.append([os.path.abspath(pkg_filename), os.path.abspath(new_pkg_filename), compress_xml])
+    results = []
+    if len(pending) > 0:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = jobs if jobs > 0 else None) as executor:
+            for result in pool_results(executor.map(pool_job(decompress_pkg_job), pending, chunksize = 4)):
+                if result[3] is not None:
+                    print("Failed: {0} ({1})".format(os.path.basename(result[0]), result[3]))
+                results.append(result)
+    elapsed_time = time.perf_counter() - start_time
+    failures = [x for x in results if x[3] is not None]
+    bytes_read, bytes_written = sum([x[1] for x in results]), sum([x[2] for x in results])
+    print("Decompressed {0} packages, skipped {1} up to date, {2} failed.".format(len(results) - len(failures), skipped, len(failures)))
+    print("Read {0:.1f} MB, wrote {1:.1f} MB in {2:.2f}s ({3:.1f} MB/s read, {4:.1f} MB/s written).".format(\
+        bytes_read / 1048576, bytes_written / 1048576, elapsed_time,\
+        bytes_read / 1048576 / elapsed_time if elapsed_time > 0 else 0, bytes_written / 1048576 / elapsed_time if elapsed_time > 0 else 0))
+    if len(failures) > 0:
+        print("Failed packages: {}".format([os.path.basename(x[0]) for x in failures]))
+    return(failures)
 
 if __name__ == "__main__":
     # Set current directory
     os.chdir(os.path.abspath(os.path.dirname(__file__)))
 
+    # Optionally store the XML compressed in the output, e.g. --compress-xml lz4 (see pkg_compression.py)
+    compress_xml = pop_compression_argument(sys.argv)
+
+    # Report the time and I/O of each stage at the end, e.g. --stats or --stats-json stats.json
+    pop_stats_arguments(sys.argv)
+
+    # The options are parsed first, so that they can be given before or after the package
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', help="Number of packages to decompress in parallel (default: one per CPU)", type=int, default=0)
+    parser.add_argument('-f', '--force', help="Decompress even if the output is already up to date", action="store_true")
+    parser.add_argument('packages', nargs='?', help="Package to decompress, or folder of .pkg files or wildcard such as \"*.pkg\"")
+    args = parser.parse_args()
+
+    # Batch mode, if given a folder or a wildcard instead of a single package
+    if args.packages is not None and (os.path.isdir(args.packages) or any(x in args.packages for x in '*?[')):
+        if os.path.isdir(args.packages):
+            pkg_files = sorted(glob.glob(os.path.join(args.packages, '*.pkg')))
+        else:
+            pkg_files = sorted(glob.glob(args.packages))
+        failures = decompress_pkgs(pkg_files, 'decompressed_output', jobs = args.jobs, force = args.force, compress_xml = compress_xml)
+        sys.exit(1 if len(failures) > 0 else 0)
+
     # Grab the name of the package to decompress
-    try:
-        sourcefile = sys.argv[1].lower()
+    if args.packages is not None:
+        sourcefile = args.packages.lower()
         if sourcefile[-4:] == '.pkg':
             sourcefile = sourcefile[:-4] # Strip off the '.pkg' if present
         if not os.path.exists(sourcefile + '.pkg'):
             raise Exception('Error: Package "' + sourcefile + '" does not exist!')
-    except IndexError:
+    else:
         sourcefile = str(input("Please enter the name (e.g. C_CHR000_C02) of package: "))
         if sourcefile[-4:] == '.pkg':
             sourcefile = sourcefile[:-4] # Strip off the '.pkg' if present
@@ -30,58 +187,5 @@ if __name__ == "__main__":
     if not os.path.exists('decompressed_output'): 
         os.mkdir('decompressed_output')
 
-    # Read source model into memory
-    with open(sourcefile + '.pkg', 'rb') as f:
-        source_file_data = bytearray(f.read())
-        f.seek(4)
-        package_file_entries = []
-        total_file_entries, = struct.unpack("<I", f.read(4))
-
-        for i in range(total_file_entries):
-            file_entry_name, file_entry_uncompressed_size, file_entry_compressed_size, file_entry_offset, file_entry_flags = struct.unpack("<64sIIII", f.read(64+4+4+4+4))
-            package_file_entries.append([file_entry_offset, file_entry_compressed_size, file_entry_uncompressed_size, file_entry_flags])
-
-        # Grab the original header as a byte array, we will patch this directly later (not elegant I know)
-        patched_header = source_file_data[0:package_file_entries[0][0]]
-        archive_start_offset = package_file_entries[0][0]
-        
-        # Generate the files, to be combined with the patched header
-        package_archive = bytes()
-        new_header_data = []
-
-        current_offset = archive_start_offset
-        for file_entry_number in range(len(package_file_entries)):
-            file_entry = package_file_entries[file_entry_number]
-            f.seek(file_entry[0])
-            output_data = None
-            if file_entry[3] & 2:
-                # This is the crc32 of the file, but we don't handle this yet
-                f.seek(4, io.SEEK_CUR)
-            if file_entry[3] & 4:
-                output_data = uncompress_lz4(f, file_entry[2], file_entry[1])
-            elif file_entry[3] & 24:
-                if "zstandard" in sys.modules:
-                    output_data = uncompress_zstd(f, file_entry[2], file_entry[1])
-                else:
-                    raise Exception("File could not be decompressed because zstandard module is not installed")
-            elif file_entry[3] & 1:
-                output_data = uncompress_nislzss(f, file_entry[2], file_entry[1])
-            else:
-                output_data = f.read(file_entry[2])
-            if output_data is not None:
-                new_header_data.append([current_offset, len(output_data), len(output_data), 0])
-                package_archive = package_archive + output_data
-                current_offset = current_offset + len(output_data)
-
-    # Set the new file offsets into the patched file data
-    for offset in range(len(new_header_data)):
-        offset_location = (offset+1)*80-8
-        patched_header[offset_location:offset_location+16] = new_header_data[offset][1].to_bytes(4, 'little') + new_header_data[offset][2].to_bytes(4, 'little') + new_header_data[offset][0].to_bytes(4, 'little') + new_header_data[offset][3].to_bytes(4, 'little')
-
-    #Reassemble the .pkg file
-    patched_file_data = patched_header + package_archive
-
-    # Write patched model into target
-    with open('decompressed_output/' + sourcefile + '.pkg', 'wb') as f:
-        f.write(patched_file_data)
-
+    # Write decompressed package
+    decompress_pkg(sourcefile + '.pkg', 'decompressed_output/' + sourcefile + '.pkg', compress_xml)
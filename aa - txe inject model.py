@@ -4,12 +4,15 @@
 
 import sys, os, shutil, struct, io
 from txe_file_extract import * # TXe File Extraction Library
-from unpackpkg import * # Needed due to XML compression
+from pkg_compression import * # Optional compression of the rewritten XML, and the decompressors of unpackpkg.py
 
 if __name__ == "__main__":
     # Set current directory
     os.chdir(os.path.abspath(os.path.dirname(__file__)))
 
+    # Optionally store a rewritten XML compressed again, e.g. --compress-xml same (see pkg_compression.py)
+    compression = pop_compression_argument(sys.argv)
+
     # Grab the name of the source model (model to inject)
     try:
         sourcefile = sys.argv[1].lower()
@@ -135,8 +138,11 @@ if __name__ == "__main__":
         # Patch uncompressed XML file with substitution string
         xml_file = bytearray(xml_file.replace(bytes(source_string, 'ascii'),bytes(target_string, 'ascii')))
 
+        # Compress the XML again if asked to, otherwise it is stored uncompressed
+        stored_xml_file, stored_xml_flags = compress_entry(xml_file, compression, xml_compression_type)
+
         # Calculate offset difference for files beyond the XML file
-        offset_difference = len(xml_file) - xml_file_info_from_header[1]
+        offset_difference = len(stored_xml_file) - xml_file_info_from_header[1]
 
         # Split the .pkg file into header, {XML - not needed}, and file archive.
         patched_header = patched_file_data[0:xml_file_info_from_header[0]]
@@ -160,11 +166,11 @@ if __name__ == "__main__":
                 patched_header[offset_location+intbyte] = offset_bytes[intbyte]
         # Calculate and set the new XML file size
         patched_header[72:76] = len(xml_file).to_bytes(4, 'little') # Uncompressed size
-        patched_header[76:80] = len(xml_file).to_bytes(4, 'little') # Compressed size (no longer compressed)
-        patched_header[84:88] = (0).to_bytes(4, 'little') # Set compression flag to 0
+        patched_header[76:80] = len(stored_xml_file).to_bytes(4, 'little') # Compressed size (same if no longer compressed)
+        patched_header[84:88] = stored_xml_flags.to_bytes(4, 'little') # Compression flag, 0 unless compressed again
 
         #Reassemble the .pkg file
-        patched_file_data = patched_header + xml_file + patched_file_archive
+        patched_file_data = patched_header + stored_xml_file + patched_file_archive
 
     # Write patched model into target
     with open(targetfile + '.pkg', 'wb') as f:
@@ -1,50 +1,118 @@
 # Short script to inject one model into another in Falcom games.  If a source backup exists, it will use the backup
 # instead of the existing file.  If no target backup exists, it will create one before erasing the target.
 #
-# Requires my fork of unpackpkg.py, put in the same directory
+# Requires my fork of unpackpkg.py, archive_handles.py, pkg_compression.py and stage_stats.py, put in the same directory
 #
 # GitHub eArmada8/misc_kiseki
 
-import sys, os, shutil, struct, io
-from unpackpkg import * # Needed for games that compress the XML file
+import sys, os, shutil, struct, io, mmap, itertools, json, threading, queue
+from archive_handles import * # Shared pool of memory-mapped archives
+from pkg_compression import * # Compression of rewritten entries, and the decompressors of unpackpkg.py (loaded on first use)
+import stage_stats
+from stage_stats import * # Optional --stats instrumentation
 
-def get_pkg_contents (f, package_name = ''):
+pkg_entry_struct = struct.Struct("<64s4I")
+
+# Lazy version of get_pkg_contents.  The whole TOC is read at once, then decoded record by record.
+def iter_pkg_contents (f, package_name = ''):
     f.seek(0,0)
-    file_contents = []
     magic = f.read(4)
     total_files, = struct.unpack("<I", f.read(4))
-    for i in range(total_files):
-        file = {}
-        file["file_entry_name"], file["file_entry_uncompressed_size"],\
-            file["file_entry_compressed_size"], file["file_entry_offset"],\
-            file["file_entry_flags"] = struct.unpack("<64s4I", f.read(80))
-        file["file_entry_name"] = file["file_entry_name"].rstrip(b"\x00").decode('utf-8')
-        file["package_name"] = package_name
-        file_contents.append(file)
+    toc_data = f.read(total_files * pkg_entry_struct.size)
+    for file_entry_name, file_entry_uncompressed_size, file_entry_compressed_size, file_entry_offset,\
+            file_entry_flags in pkg_entry_struct.iter_unpack(toc_data):
+        yield({"file_entry_name": file_entry_name.rstrip(b"\x00").decode('utf-8'),\
+            "file_entry_uncompressed_size": file_entry_uncompressed_size,\
+            "file_entry_compressed_size": file_entry_compressed_size,\
+            "file_entry_offset": file_entry_offset,\
+            "file_entry_flags": file_entry_flags,\
+            "package_name": package_name})
+
+def get_pkg_contents (f, package_name = ''):
+    with stage('toc'):
+        file_contents = list(iter_pkg_contents(f, package_name))
+    count('toc', entries = len(file_contents), bytes_read = 8 + 80 * len(file_contents))
     return(file_contents)
 
+# Reads the entry described by file_entry (one of the dicts from get_pkg_contents) from f
+def retrieve_entry (f, file_entry, decompress = True):
+    if stage_stats.stage_totals is None: # Stats disabled, skip the per-entry bookkeeping
+        return(read_entry_data(f, file_entry, decompress))
+    stage_name = 'decompress' if decompress and file_entry["file_entry_flags"] & 29 else 'read'
+    with stage(stage_name):
+        data = read_entry_data(f, file_entry, decompress)
+    count(stage_name, entries = 1, bytes_read = file_entry["file_entry_compressed_size"], bytes_written = len(data))
+    return(data)
+
+def read_entry_data (f, file_entry, decompress = True):
+    f.seek(file_entry["file_entry_offset"],0)
+    if file_entry["file_entry_flags"] & 1 and decompress:
+        return(uncompress_nislzss(f, file_entry["file_entry_uncompressed_size"], file_entry["file_entry_compressed_size"]))
+    elif file_entry["file_entry_flags"] & 4 and decompress:
+        return(uncompress_lz4(f, file_entry["file_entry_uncompressed_size"], file_entry["file_entry_compressed_size"]))
+    elif file_entry["file_entry_flags"] & 24 and decompress:
+        return(uncompress_zstd(f, file_entry["file_entry_uncompressed_size"], file_entry["file_entry_compressed_size"]))
+    elif isinstance(f, mmap.mmap) and not decompress:
+        # Raw entries are sliced from the mapping without copying
+        return(memoryview(f)[file_entry["file_entry_offset"]:\
+            file_entry["file_entry_offset"]+file_entry["file_entry_compressed_size"]])
+    else:
+        return(f.read(file_entry["file_entry_compressed_size"]))
+
+# Retrieves the first file whose name contains file_entry_name.  Use PkgArchive for exact name lookups.
 def retrieve_file (f, file_entry_name, file_contents, decompress = True):
     file_entry = [x for x in file_contents if file_entry_name in x["file_entry_name"]]
     if len(file_entry) > 0:
-        f.seek(file_entry[0]["file_entry_offset"],0)
-        if file_entry[0]["file_entry_flags"] & 1 and decompress:
-            return(uncompress_nislzss(f, file_entry[0]["file_entry_uncompressed_size"], file_entry[0]["file_entry_compressed_size"]))
-        elif file_entry[0]["file_entry_flags"] & 4 and decompress:
-            return(uncompress_lz4(f, file_entry[0]["file_entry_uncompressed_size"], file_entry[0]["file_entry_compressed_size"]))
-        elif file_entry[0]["file_entry_flags"] & 24 and decompress:
-            return(uncompress_zstd(f, file_entry[0]["file_entry_uncompressed_size"], file_entry[0]["file_entry_compressed_size"]))
-        else:
-            return(f.read(file_entry[0]["file_entry_compressed_size"]))
+        return(retrieve_entry(f, file_entry[0], decompress))
     else:
         return False
 
 def retrieve_xml_file (f, file_contents):
     xml_entry = [x for x in file_contents if 'xml' in x["file_entry_name"]]
     if len(xml_entry) > 0:
-        return retrieve_file(f, xml_entry[0]["file_entry_name"], file_contents, decompress = True)
+        return retrieve_entry(f, xml_entry[0], decompress = True)
     else:
         return False
 
+# A package opened through the archive pool, with its TOC (the same list of dicts as get_pkg_contents)
+# indexed by exact entry name.  Where a name occurs more than once, the index points to the first one.
+class PkgArchive:
+    def __init__ (self, pkg_filename, package_name = ''):
+        self.filename = pkg_filename
+        self.f = open_archive(pkg_filename)
+        self.file_contents = get_pkg_contents(self.f, package_name)
+        self.index = {}
+        for i in range(len(self.file_contents)):
+            self.index.setdefault(self.file_contents[i]["file_entry_name"], i)
+
+    def __len__ (self):
+        return(len(self.file_contents))
+
+    def __iter__ (self):
+        return(iter(self.file_contents))
+
+    def __contains__ (self, file_entry_name):
+        return(file_entry_name in self.index)
+
+    # Exact name lookup, returns the entry or False
+    def find (self, file_entry_name):
+        if file_entry_name in self.index:
+            return(self.file_contents[self.index[file_entry_name]])
+        return(False)
+
+    # Substring lookup (the behavior of retrieve_file), returns all matching entries in TOC order
+    def search (self, partial_name):
+        return([x for x in self.file_contents if partial_name in x["file_entry_name"]])
+
+    def read (self, file_entry, decompress = True):
+        return(retrieve_entry(self.f, file_entry, decompress))
+
+    def read_file (self, file_entry_name, decompress = True):
+        file_entry = self.find(file_entry_name)
+        if file_entry == False:
+            return(False)
+        return(self.read(file_entry, decompress))
+
 # Input is a file stream of a pkg file
 def retrieve_asset_symbol (f):
     file_contents = get_pkg_contents(f)
@@ -67,51 +135,593 @@ def insert_file_into_stream (f, content_struct, binary_file_data, file_details):
 
 # Updates all file offsets in the TOC based on current file size
 def update_file_offsets (content_struct):
-    current_file_offset = len(content_struct) * 80 + 8 # First file offset is always here
-    for i in range(len(content_struct)):
-        content_struct[i]["file_entry_offset"] = current_file_offset
-        current_file_offset += content_struct[i]["file_entry_compressed_size"]
+    # First file offset is always at the end of the TOC, and each later offset is a running sum of the sizes
+    file_offsets = itertools.accumulate([x["file_entry_compressed_size"] for x in content_struct],\
+        initial = len(content_struct) * 80 + 8)
+    for file_entry, file_offset in zip(content_struct, file_offsets):
+        file_entry["file_entry_offset"] = file_offset
     return(content_struct)
 
+def pack_pkg_header (content_struct, magic = b'\x00\x00\x00\x00'):
+    return(magic + struct.pack("<I", len(content_struct)) + b''.join([pkg_entry_struct.pack(\
+        x["file_entry_name"].encode("utf-8").ljust(64,b'\x00'), x["file_entry_uncompressed_size"],\
+        x["file_entry_compressed_size"], x["file_entry_offset"], x["file_entry_flags"]) for x in content_struct]))
+
 def write_pkg_file (newfilename, file_stream, content_struct, magic = b'\x00\x00\x00\x00'):
     # Assume all the file offsets are wrong, and fix them
     content_struct = update_file_offsets(content_struct)
-    with open(newfilename, 'wb') as f:
-        f.write(magic)
-        f.write(struct.pack("<I", len(content_struct)))
-        for i in range(len(content_struct)):
-            f.write(struct.pack("<64s4I", content_struct[i]["file_entry_name"].encode("utf-8").ljust(64,b'\x00'),\
-                content_struct[i]["file_entry_uncompressed_size"],\
-                content_struct[i]["file_entry_compressed_size"],\
-                content_struct[i]["file_entry_offset"],\
-                content_struct[i]["file_entry_flags"]))
+    release_archive(newfilename) # The file may still be mapped if it was also the source
+    with open(newfilename + '.tmp', 'wb') as f:
+        f.write(pack_pkg_header(content_struct, magic))
         file_stream.seek(0)
-        f.write(file_stream.read())
+        shutil.copyfileobj(file_stream, f)
+    os.replace(newfilename + '.tmp', newfilename)
+    return
+
+# A span of an existing file, for use in a write plan.  Its bytes are copied from the file when writing.
+def file_span (filename, file_entry):
+    return((filename, file_entry["file_entry_offset"], file_entry["file_entry_compressed_size"]))
+
+def copy_with_copy_file_range (src_fd, offset, length, dst_fd):
+    return(os.copy_file_range(src_fd, dst_fd, length, offset))
+
+def copy_with_sendfile (src_fd, offset, length, dst_fd):
+    return(os.sendfile(dst_fd, src_fd, offset, length))
+
+def copy_with_read (src_fd, offset, length, dst_fd):
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    return(os.write(dst_fd, os.read(src_fd, min(length, 1048576))))
+
+# Copies length bytes at offset in src_fd to the current position of dst_fd.  copy_file_range and sendfile
+# copy inside the kernel; where the OS or filesystem does not support them, the copy continues from where it
+# stopped with the next method, ending with plain reads and writes in bounded chunks.
+def copy_file_span (src_fd, offset, length, dst_fd):
+    copy_functions = []
+    if hasattr(os, 'copy_file_range'):
+        copy_functions.append(copy_with_copy_file_range)
+    if hasattr(os, 'sendfile'):
+        copy_functions.append(copy_with_sendfile)
+    copy_functions.append(copy_with_read)
+    for copy_function in copy_functions:
+        try:
+            while length > 0:
+                copied = copy_function(src_fd, offset, length, dst_fd)
+                if copied == 0:
+                    raise Exception("Error: unexpected end of file while copying!")
+                offset += copied
+                length -= copied
+            return
+        except OSError:
+            if copy_function == copy_with_read:
+                raise
+
+# Writes a package from a plan, a list of [file_details, data] in output order.  data is either a buffer
+# (bytes, bytearray, memoryview) with new contents, or a file_span() of an existing file whose bytes are copied
+# without passing through Python where the OS allows.  The new file replaces newfilename only once complete,
+# so a source may also be the destination.
+def write_pkg_plan (newfilename, plan, magic = b'\x00\x00\x00\x00'):
+    # The details are copied, so the offsets of the source TOCs are not changed
+    content_struct = update_file_offsets([dict(x[0]) for x in plan])
+    source_fds = {}
+    count('write', entries = len(plan), bytes_written = 8 + 80 * len(plan) + sum([x["file_entry_compressed_size"] for x in content_struct]))
+    try:
+        with stage('write'), open(newfilename + '.tmp', 'wb', buffering = 0) as f:
+            f.write(pack_pkg_header(content_struct, magic))
+            for file_details, data in plan:
+                write_plan_entry(f, data, source_fds)
+    except BaseException:
+        # A failed copy never leaves a partial package behind
+        if os.path.exists(newfilename + '.tmp'):
+            os.remove(newfilename + '.tmp')
+        raise
+    finally:
+        for fd in source_fds.values():
+            os.close(fd)
+    release_archive(newfilename) # The file may still be mapped if it was also the source
+    os.replace(newfilename + '.tmp', newfilename)
     return
 
-def inject_asset_symbol_into_pkg(pkg_filename, new_pkg_filename, asset_symbol):
-    with open(pkg_filename, 'rb') as f:
-        file_contents = get_pkg_contents(f)
-        new_file_contents = []
-        new_file_stream = io.BytesIO()
-        for i in range(len(file_contents)):
-            if 'xml' in file_contents[i]["file_entry_name"]:
-                file = retrieve_file (f, file_contents[i]["file_entry_name"], file_contents, decompress = True)
-                file = change_xml_asset_symbol(file, asset_symbol)
-                new_file_contents = insert_file_into_stream (new_file_stream, new_file_contents, file,\
-                    {"file_entry_name": file_contents[i]["file_entry_name"],\
-                    "file_entry_uncompressed_size": len(file),\
-                    "file_entry_compressed_size": len(file),\
-                    "file_entry_offset": 0, "file_entry_flags": 0}) # Offset will be fixed at time of packing
+# Writes the data of one plan entry at the current position of f (opened unbuffered).  source_fds caches the
+# file descriptors of the files that spans are copied from, and is closed by the caller.
+def write_plan_entry (f, data, source_fds):
+    if isinstance(data, tuple):
+        if data[0] not in source_fds:
+            source_fds[data[0]] = os.open(data[0], os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        copy_file_span(source_fds[data[0]], data[1], data[2], f.fileno())
+    else:
+        data = memoryview(data)
+        while len(data) > 0:
+            data = data[f.write(data):]
+
+# An entry of a plan can also be a callable that returns [file_details, data], so that the work of making it
+# (decompression, XML conversion, compression) can be left to the transform stage of write_pkg_plans_pipelined
+def resolve_plan_entry (plan_entry):
+    return(plan_entry() if callable(plan_entry) else plan_entry)
+
+# Decompresses the stored bytes of an entry (as read with decompress = False), e.g. in another thread than the
+# one that read them
+def decompress_stored_entry (file_entry, stored_data):
+    return(retrieve_entry(io.BytesIO(stored_data), dict(file_entry, file_entry_offset = 0), decompress = True))
+
+# Pipelined writing.  pipeline() runs the stages of a job in their own threads, with bounded queues between
+# them, so that reading, compute and writing overlap while only a few entries are held in memory.  The end of
+# each stage, or its exception, is passed down the queues after its items.
+pipeline_queue_size = 16 # Items held between two stages
+pipeline_chunk_size = 64 # Entries per item when writing packages
+pipeline_end = object()
+
+class PipelineError:
+    def __init__ (self, exception):
+        self.exception = exception
+
+# Both return early once stop is set, so the other stages never wait on a stage that has failed
+def put_in_pipeline (pipeline_queue, item, stop):
+    while not stop.is_set():
+        try:
+            pipeline_queue.put(item, timeout = 0.1)
+            return(True)
+        except queue.Full:
+            pass
+    return(False)
+
+def iter_pipeline_queue (pipeline_queue, stop):
+    while not stop.is_set():
+        try:
+            item = pipeline_queue.get(timeout = 0.1)
+        except queue.Empty:
+            continue
+        if item is pipeline_end:
+            return
+        if isinstance(item, PipelineError):
+            raise item.exception
+        yield(item)
+
+def run_pipeline_stage (function, items, output_queue, stop):
+    try:
+        for item in items:
+            if not put_in_pipeline(output_queue, item if function is None else function(item), stop):
+                return
+    except BaseException as e:
+        put_in_pipeline(output_queue, PipelineError(e), stop)
+        return
+    put_in_pipeline(output_queue, pipeline_end, stop)
+
+# One thread iterates items (so a generator does its reading there), then each of functions runs in a thread of
+# its own.  Yields the results in order, in the calling thread, which is the last stage.  An exception in any
+# stage is raised here after the results before it, as if the stages had run one after the other.
+def pipeline (items, functions, queue_size = pipeline_queue_size):
+    stop = threading.Event()
+    threads = []
+    for function in [None] + list(functions):
+        output_queue = queue.Queue(maxsize = queue_size)
+        threads.append(threading.Thread(target = run_pipeline_stage, args = (function, items, output_queue, stop), daemon = True))
+        threads[-1].start()
+        items = iter_pipeline_queue(output_queue, stop)
+    try:
+        yield from items
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+# The entries go down the pipeline in chunks, to pass the queues less often.  A callable entry ends its chunk,
+# so that the entries before it can be written while it runs.
+def iter_rewrite_items (rewrites):
+    for newfilename, plan, magic in rewrites:
+        yield(['open', newfilename, len(plan), magic])
+        chunk = []
+        for plan_entry in plan:
+            chunk.append(plan_entry)
+            if callable(plan_entry) or len(chunk) == pipeline_chunk_size:
+                yield(['entries', chunk])
+                chunk = []
+        if len(chunk) > 0:
+            yield(['entries', chunk])
+        yield(['close'])
+
+def resolve_rewrite_item (item):
+    if item[0] == 'entries':
+        return(['entries', [resolve_plan_entry(x) for x in item[1]]])
+    return(item)
+
+# Pipelined version of write_pkg_plan for a batch of packages.  rewrites is an iterable of [newfilename, plan,
+# magic], usually a generator that backs up and plans each package, and the entries of a plan may be callables
+# (see resolve_plan_entry).  Planning and reading, the callables and the writing run as three stages, so the next
+# package is read while one is written, and a large entry is converted while the entries around it are copied.
+# The header is written last, once every size is known, so the files are the same as from write_pkg_plan.
+def write_pkg_plans_pipelined (rewrites, queue_size = pipeline_queue_size):
+    f, source_fds = None, {}
+    try:
+        for item in pipeline(iter_rewrite_items(rewrites), [resolve_rewrite_item], queue_size):
+            if item[0] == 'open':
+                newfilename, number_of_entries, magic = item[1:]
+                content_struct, file_entry_offset = [], 8 + 80 * number_of_entries
+                f = open(newfilename + '.tmp', 'wb', buffering = 0)
+                f.seek(file_entry_offset)
+            elif item[0] == 'entries':
+                with stage('write'):
+                    for file_details, data in item[1]:
+                        write_plan_entry(f, data, source_fds)
+                        content_struct.append(dict(file_details, file_entry_offset = file_entry_offset))
+                        file_entry_offset += file_details["file_entry_compressed_size"]
             else:
-                file = retrieve_file (f, file_contents[i]["file_entry_name"], file_contents, decompress = False)
-                new_file_contents = insert_file_into_stream (new_file_stream, new_file_contents, file, file_contents[i])
-    write_pkg_file (new_pkg_filename, new_file_stream, new_file_contents, magic = b'\x00\x00\x00\x00')
+                with stage('write'):
+                    f.seek(0)
+                    f.write(pack_pkg_header(content_struct, magic))
+                    f.close()
+                f = None
+                count('write', entries = len(content_struct), bytes_written = file_entry_offset)
+                for fd in source_fds.values():
+                    os.close(fd)
+                source_fds = {}
+                release_archive(newfilename) # The file may still be mapped if it was also the source
+                os.replace(newfilename + '.tmp', newfilename)
+    finally:
+        for fd in source_fds.values():
+            os.close(fd)
+        if f is not None:
+            f.close()
+            os.remove(newfilename + '.tmp')
+    return
+
+# Backups (.bak, .original) do not need to be full copies.  Packages are never modified in place: a new file is
+# always written and then moved over the old one, which leaves any other link to the old file untouched.  So a
+# reflink clone (which shares the data until either copy is changed) or a hardlink keeps the original just as
+# safely as a copy, without writing the data again.
+ficlone_ioctl = 0x40049409 # FICLONE from linux/fs.h
+
+def backup_with_reflink (filename, backup_filename):
+    import fcntl
+    try:
+        with open(filename, 'rb') as f, open(backup_filename + '.tmp', 'wb') as f_backup:
+            fcntl.ioctl(f_backup.fileno(), ficlone_ioctl, f.fileno())
+        shutil.copystat(filename, backup_filename + '.tmp')
+        os.replace(backup_filename + '.tmp', backup_filename)
+    except OSError:
+        if os.path.exists(backup_filename + '.tmp'):
+            os.remove(backup_filename + '.tmp')
+        raise
+
+def backup_with_hardlink (filename, backup_filename):
+    os.link(filename, backup_filename + '.tmp')
+    os.replace(backup_filename + '.tmp', backup_filename)
+
+def backup_with_copy (filename, backup_filename):
+    shutil.copy2(filename, backup_filename)
+
+# Methods to try in order, from the cheapest.  Can be changed, e.g. to [backup_with_copy] for full copies only.
+backup_methods = [backup_with_reflink, backup_with_hardlink, backup_with_copy]
+
+# Drop-in replacement for shutil.copy2 to make a backup, using the first of backup_methods that works here
+def backup_file (filename, backup_filename):
+    if os.path.exists(backup_filename) and os.path.samefile(filename, backup_filename):
+        return # Already linked to the same file
+    with stage('backup'):
+        for backup_method in backup_methods:
+            try:
+                backup_method(filename, backup_filename)
+                break
+            except (OSError, ImportError, AttributeError, NotImplementedError):
+                if backup_method == backup_methods[-1]:
+                    raise
+    count('backup', entries = 1)
+
+# Change plans are the JSON form of the write plans of a whole run (--plan): which packages would be rewritten,
+# which of their entries would change and where each new entry comes from.  They are made from the TOCs alone,
+# so a run can be reviewed and its I/O sized before anything is written, and then executed exactly.
+change_plan_version = 1
+
+# Size and modification time, to detect files that have changed since a change plan was made
+def get_file_key (filename):
+    file_stat = os.stat(filename)
+    return([file_stat.st_size, file_stat.st_mtime_ns])
+
+# Describes the entries of a write plan for pkg_filename that differ from the package.  Returns the list of
+# changes and the size of the package that the plan would write.  Paths are stored relative to base_dir.
+def describe_pkg_plan (pkg_filename, plan, base_dir = ''):
+    pkg = PkgArchive(pkg_filename)
+    pkg_path = os.path.abspath(pkg_filename)
+    changes = []
+    for i in range(len(plan)):
+        file_details, data = plan[i]
+        file_entry = pkg.file_contents[i] if i < len(pkg) else {}
+        unchanged = isinstance(data, tuple) and os.path.abspath(data[0]) == pkg_path\
+            and data[1] == file_entry.get("file_entry_offset")
+        for key in ["file_entry_name", "file_entry_uncompressed_size", "file_entry_compressed_size", "file_entry_flags"]:
+            unchanged = unchanged and file_details[key] == file_entry.get(key)
+        if not unchanged:
+            change = {"index": i, "original_name": file_entry.get("file_entry_name"),\
+                "name": file_details["file_entry_name"],\
+                "uncompressed_size": file_details["file_entry_uncompressed_size"],\
+                "compressed_size": file_details["file_entry_compressed_size"],\
+                "flags": file_details["file_entry_flags"]}
+            if isinstance(data, tuple):
+                change["source"] = os.path.relpath(data[0], base_dir or os.getcwd())
+                change["source_offset"] = data[1]
+                if file_details.get("package_name"):
+                    change["package_name"] = file_details["package_name"]
+            changes.append(change)
+    new_size = len(plan) * 80 + 8 + sum([x[0]["file_entry_compressed_size"] for x in plan])
+    return(changes, new_size)
+
+# Rebuilds the write plan for pkg_filename from the changes of a change plan.  Changes without a source are made
+# by calling transforms[change["transform"]] with the decompressed original entry, then compressing the result
+# with change["compression"] if given.
+def pkg_plan_from_changes (pkg_filename, changes, transforms = None):
+    if transforms is None:
+        transforms = {}
+    pkg = PkgArchive(pkg_filename)
+    changes = {x["index"]: x for x in changes}
+    plan = []
+    for i in range(len(pkg)):
+        file_entry = pkg.file_contents[i]
+        if i in changes:
+            change = changes[i]
+            if change["original_name"] != file_entry["file_entry_name"]:
+                raise Exception('Error: Entry {0} of "{1}" does not match the plan!'.format(i, pkg_filename))
+            file_details = {"file_entry_name": change["name"],\
+                "file_entry_uncompressed_size": change["uncompressed_size"],\
+                "file_entry_compressed_size": change["compressed_size"],\
+                "file_entry_offset": 0, "file_entry_flags": change["flags"]} # Offset will be fixed at time of packing
+            if "source" in change:
+                plan.append([file_details, (change["source"], change["source_offset"], change["compressed_size"])])
+            else:
+                data = transforms[change["transform"]](pkg.read(file_entry, decompress = True))
+                if change.get("compression", 'none') != 'none':
+                    data = compress_entry(data, change["compression"], file_entry["file_entry_flags"])[0]
+                if len(data) != change["compressed_size"]:
+                    raise Exception('Error: Entry {0} of "{1}" does not match the plan!'.format(i, pkg_filename))
+                plan.append([file_details, data])
+        else:
+            plan.append([file_entry, file_span(pkg_filename, file_entry)])
+    return(plan)
+
+def save_change_plan (plan_filename, change_plan):
+    change_plan["bytes_to_back_up"] = sum([x["key"][0] for x in change_plan["packages"] if x.get("backup")])
+    change_plan["bytes_to_write"] = sum([x["new_size"] for x in change_plan["packages"]])
+    with open(plan_filename, 'w') as f:
+        json.dump(change_plan, f, indent=4)
+    return
+
+# Loads a change plan made by tool, and checks that none of its packages or sources have changed since
+def load_change_plan (plan_filename, tool):
+    with open(plan_filename, 'r') as f:
+        change_plan = json.load(f)
+    if change_plan.get("version") != change_plan_version or change_plan.get("tool") != tool:
+        raise Exception('Error: "{0}" is not a change plan for {1}!'.format(plan_filename, tool))
+    for filename, key in [[x["package"], x["key"]] for x in change_plan["packages"]] + list(change_plan["sources"].items()):
+        if not os.path.exists(filename) or get_file_key(filename) != key:
+            raise Exception('Error: "{0}" has changed since the plan was made!'.format(filename))
+    return(change_plan)
+
+# Makes new_filename a copy of filename, as a reflink clone where the filesystem supports it
+def clone_file (filename, new_filename):
+    with open(filename, 'rb') as f, open(new_filename, 'wb') as f_new:
+        try:
+            import fcntl
+            fcntl.ioctl(f_new.fileno(), ficlone_ioctl, f.fileno())
+        except (OSError, ImportError):
+            copy_file_span(f.fileno(), 0, os.fstat(f.fileno()).st_size, f_new.fileno())
+    shutil.copymode(filename, new_filename)
+
+# Fast path of inject_asset_symbol_into_pkg, for when the XML is stored uncompressed and the new asset symbol has
+# the same length as the old one.  The package would then be rewritten byte for byte except for the symbol, so
+# the source is cloned (a reflink where the filesystem supports it) and only the symbol is written into the clone,
+# which then replaces the target.  pkg is the PkgArchive of pkg_filename and xml_entries its XML entries from
+# read_xml_entries().  Returns False, without writing anything, if the result would not be identical to a full rewrite.
+def patch_asset_symbol_in_pkg(pkg, pkg_filename, new_pkg_filename, asset_symbol, xml_entries):
+    content_struct = []
+    patches = []
+    for i, file_entry in enumerate(pkg):
+        if i in xml_entries:
+            if file_entry["file_entry_flags"] != 0:
+                return(False)
+            file = xml_entries[i]
+            new_file = change_xml_asset_symbol(file, asset_symbol)
+            if len(new_file) != len(file):
+                return(False)
+            if new_file != file:
+                patches.append([file_entry["file_entry_offset"], new_file])
+            content_struct.append(dict(file_entry, file_entry_uncompressed_size = len(file)))
+        else:
+            content_struct.append(dict(file_entry))
+    # The header (magic, TOC, offsets) and the end of the last entry must be exactly as write_pkg_plan writes them
+    header = pack_pkg_header(update_file_offsets(content_struct), magic = b'\x00\x00\x00\x00')
+    if pkg.f[0:len(header)] != header or len(pkg.f) != len(header) + sum([x["file_entry_compressed_size"] for x in pkg]):
+        return(False)
+    count('write', entries = len(patches), bytes_written = sum([len(x[1]) for x in patches]))
+    try:
+        with stage('clone'):
+            clone_file(pkg_filename, new_pkg_filename + '.tmp')
+        with stage('write'), open(new_pkg_filename + '.tmp', 'r+b') as f:
+            for offset, new_file in patches:
+                f.seek(offset)
+                f.write(new_file)
+    except BaseException:
+        # A failed copy never leaves a partial package behind
+        if os.path.exists(new_pkg_filename + '.tmp'):
+            os.remove(new_pkg_filename + '.tmp')
+        raise
+    release_archive(new_pkg_filename) # The file may still be mapped if it was also the source
+    os.replace(new_pkg_filename + '.tmp', new_pkg_filename)
+    return(True)
+
+# Details of a new entry for a write plan, compressed with compression (see pkg_compression.py) if not 'none'.
+# Returns [file_details, data].
+def make_new_entry(file_entry_name, file, compression = 'none', original_flags = 0):
+    compressed_file, file_entry_flags = compress_entry(file, compression, original_flags)
+    return([{"file_entry_name": file_entry_name,\
+        "file_entry_uncompressed_size": len(file),\
+        "file_entry_compressed_size": len(compressed_file),\
+        "file_entry_offset": 0, "file_entry_flags": file_entry_flags}, compressed_file]) # Offset will be fixed at time of packing
+
+# The decompressed XML entries of a package, by position in the TOC.  These are the only entries that injection
+# reads rather than copies, so batch mode keeps them to read each source package only once.
+def read_xml_entries (pkg):
+    return({i: bytes(pkg.read(pkg.file_contents[i], decompress = True)) for i in range(len(pkg))\
+        if 'xml' in pkg.file_contents[i]["file_entry_name"]})
+
+def inject_asset_symbol_into_pkg(pkg_filename, new_pkg_filename, asset_symbol, compression = 'none', xml_entries = None):
+    pkg = PkgArchive(pkg_filename)
+    if xml_entries is None:
+        xml_entries = read_xml_entries(pkg)
+    if compression == 'none' and patch_asset_symbol_in_pkg(pkg, pkg_filename, new_pkg_filename, asset_symbol, xml_entries):
+        return
+    plan = []
+    for i, file_entry in enumerate(pkg):
+        if i in xml_entries:
+            file = change_xml_asset_symbol(xml_entries[i], asset_symbol)
+            plan.append(make_new_entry(file_entry["file_entry_name"], file, compression, file_entry["file_entry_flags"]))
+        else:
+            plan.append([file_entry, file_span(pkg_filename, file_entry)])
+    write_pkg_plan (new_pkg_filename, plan, magic = b'\x00\x00\x00\x00')
+
+# Removes an option with a value (e.g. --jobs N, -j N or --jobs=N) from the command line, so the positional
+# arguments work as before.  Returns its value, or default if it is not present.
+def pop_value_argument(argv, flags, default = None):
+    value = default
+    for i in range(len(argv)-1, 0, -1):
+        for flag in flags:
+            if argv[i][:len(flag)+1] == flag + '=':
+                value = argv.pop(i)[len(flag)+1:]
+                break
+            elif argv[i] == flag and i + 1 < len(argv):
+                value = argv.pop(i+1)
+                argv.pop(i)
+                break
+    return(value)
+
+# Removes a flag (e.g. --incremental) from the command line, returns whether it was present
+def pop_flag_argument(argv, flags):
+    found = False
+    for i in range(len(argv)-1, 0, -1):
+        if argv[i] in flags:
+            argv.pop(i)
+            found = True
+    return(found)
+
+# Package name as the command line takes it (e.g. c_chr000_c02.pkg), as it is used (e.g. C_CHR000_C02)
+def normalize_pkg_name (pkg_name):
+    pkg_name = pkg_name.strip()
+    if pkg_name[-4:].lower() == '.pkg':
+        pkg_name = pkg_name[:-4] # Strip off the '.pkg' if present
+    return(pkg_name.upper())
+
+# Reads a swap manifest: either a .json list of [source, target] pairs (or of {"source": ..., "target": ...}),
+# or a .csv file with one source,target pair per line.  Empty lines, lines starting with # and a header line
+# of "source,target" are skipped in the .csv.  Returns a list of [source, target] pairs.
+def read_swap_manifest (manifest_filename):
+    swaps = []
+    if manifest_filename[-5:].lower() == '.json':
+        with open(manifest_filename, 'r', encoding='utf-8') as f:
+            for swap in json.load(f):
+                if isinstance(swap, dict):
+                    swap = [swap["source"], swap["target"]]
+                swaps.append([normalize_pkg_name(swap[0]), normalize_pkg_name(swap[1])])
+    else:
+        import csv
+        with open(manifest_filename, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) == 0 or row[0].strip() == '' or row[0].strip()[0] == '#'\
+                        or [x.strip().lower() for x in row[0:2]] == ['source', 'target']:
+                    continue
+                if len(row) < 2:
+                    raise Exception('Error: Line "{0}" of manifest {1} is not a source,target pair!'.format(','.join(row), manifest_filename))
+                swaps.append([normalize_pkg_name(row[0]), normalize_pkg_name(row[1])])
+    return(swaps)
+
+# Injects one source into several targets.  The source package is read once, and its XML entries are reused for
+# every target.  targets is a list of [target package name, asset symbol].  Returns [output, number of targets
+# injected, error or None].
+def inject_source_into_targets (file_to_inject, targets, compression = 'none'):
+    output = []
+    try:
+        xml_entries = read_xml_entries(PkgArchive(file_to_inject))
+        for targetfile, asset_symbol in targets:
+            inject_asset_symbol_into_pkg(file_to_inject, targetfile + '.pkg', asset_symbol, compression, xml_entries)
+            output.append("Injected {0} into {1}.pkg.".format(file_to_inject, targetfile))
+        return(["\n".join(output), len(output), None])
+    except Exception as e:
+        return(["\n".join(output), len(output), "{0}: {1}".format(type(e).__name__, e)])
+
+def inject_source_into_targets_job (job):
+    return(inject_source_into_targets(*job))
+
+# Runs all the swaps of a manifest (a list of [source, target] pairs) in one process.  All the target backups
+# are made first, so every source that is also a target is read from its .pkg.original, exactly as if the swaps
+# had been run one at a time: the order of the swaps does not matter, and A->B with B->A swaps the two models.
+# The asset symbol of each original is read once, and the swaps are then grouped by source, so each source
+# package is read once; the groups are independent and run in parallel with jobs > 1 (0 = one per CPU).
+# Returns the list of errors.
+def inject_swap_manifest (swaps, compression = 'none', jobs = 1):
+    errors = []
+    injected = 0
+    target_counts = {}
+    for sourcefile, targetfile in swaps:
+        for pkg_name in [sourcefile, targetfile]:
+            if not os.path.exists(pkg_name + '.pkg'):
+                raise Exception('Error: Package "' + pkg_name + '" does not exist!')
+        target_counts[targetfile] = target_counts.get(targetfile, 0) + 1
+    if max(target_counts.values(), default = 0) > 1:
+        raise Exception('Error: Packages {0} are the target of more than one swap!'.format(\
+            sorted([x for x in target_counts if target_counts[x] > 1])))
+
+    # Make the target backups, only if no backup exists, then read each original asset symbol once
+    asset_symbols = {}
+    for targetfile in target_counts:
+        if not os.path.exists(targetfile + '.pkg.original'):
+            backup_file(targetfile + '.pkg', targetfile + '.pkg.original')
+        with open(targetfile + '.pkg.original', 'rb') as f:
+            asset_symbols[targetfile] = retrieve_asset_symbol(f)
+
+    # Group the targets by the file to inject.  If an original file exists, use that file, otherwise the current file.
+    jobs_by_source = {}
+    for sourcefile, targetfile in swaps:
+        if os.path.exists(sourcefile + '.pkg.original'):
+            file_to_inject = sourcefile + '.pkg.original'
+        else:
+            file_to_inject = sourcefile + '.pkg'
+        jobs_by_source.setdefault(file_to_inject, []).append([targetfile, asset_symbols[targetfile]])
+    injection_jobs = [[x, jobs_by_source[x], compression] for x in jobs_by_source]
+
+    if jobs == 1 or len(injection_jobs) < 2:
+        results = (inject_source_into_targets_job(x) for x in injection_jobs)
+    else:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs if jobs > 0 else None)
+        results = pool_results(executor.map(pool_job(inject_source_into_targets_job), injection_jobs))
+    try:
+        for i in range(len(injection_jobs)):
+            output, injected_count, error = next(results)
+            injected += injected_count
+            if output != '':
+                print(output)
+            if error is not None:
+                print("Failed: {0} ({1})".format(injection_jobs[i][0], error))
+                errors.append([injection_jobs[i][0], error])
+    finally:
+        if not (jobs == 1 or len(injection_jobs) < 2):
+            executor.shutdown()
+    print("{0} swaps from {1} source packages, {2} failed.".format(len(swaps), len(injection_jobs), len(swaps) - injected))
+    return(errors)
 
 if __name__ == "__main__":
     # Set current directory
     os.chdir(os.path.abspath(os.path.dirname(__file__)))
 
+    # Optionally store the rewritten XML compressed, e.g. --compress-xml lz4 (see pkg_compression.py)
+    compression = pop_compression_argument(sys.argv)
+
+    # Optionally report the time and I/O of each stage at the end, e.g. --stats or --stats-json stats.json
+    pop_stats_arguments(sys.argv)
+
+    # Batch mode: all the swaps of a manifest (see read_swap_manifest) in one run, e.g. --manifest swaps.csv --jobs 4
+    manifest_filename = pop_value_argument(sys.argv, ['-m', '--manifest'])
+    if manifest_filename is not None:
+        jobs = int(pop_value_argument(sys.argv, ['-j', '--jobs'], 1))
+        errors = inject_swap_manifest(read_swap_manifest(manifest_filename), compression, jobs)
+        sys.exit(1 if len(errors) > 0 else 0)
+
     # Grab the name of the source model (model to inject)
     try:
         sourcefile = sys.argv[1].lower()
@@ -154,11 +764,11 @@ if __name__ == "__main__":
 
     # Make a target backup, only if no backup exists.
     if not os.path.exists(targetfile + '.pkg.original'):
-        shutil.copy2(targetfile + '.pkg', targetfile + '.pkg.original')
+        backup_file(targetfile + '.pkg', targetfile + '.pkg.original')
 
     # Grab original asset symbol
     with open(targetfile + '.pkg.original', 'rb') as f:
         new_asset_symbol = retrieve_asset_symbol(f)
 
     # Write patched model into target
-    inject_asset_symbol_into_pkg(sourcefile + '.pkg', targetfile + '.pkg', new_asset_symbol)
+    inject_asset_symbol_into_pkg(file_to_inject, targetfile + '.pkg', new_asset_symbol, compression)
@@ -2,16 +2,23 @@
 # and then it will attempt to insert all new shaders.  Thank you to My Name for pointing out
 # the method and the necessity.
 #
-# Requires aa_inject_model.py and unpackpkg.py, put in the same directory
+# Requires aa_inject_model.py, archive_handles.py, pkg_compression.py, stage_stats.py and unpackpkg.py, put in the
+# same directory
 #
 # GitHub eArmada8/misc_kiseki
 
-import sys, os, shutil, struct, io, glob
+import sys, os, shutil, struct, io, glob, contextlib
 from aa_inject_model import *
 
 #Much of this code is taken from uyjulian/unpackpka, thank you to uyjulian
-#Note there WILL be duplicate entries - e.g. asset_D3D11.xml
-def get_pka_individual_file_contents (f):
+#Returns the package entries {package name: [[file name, hash], ...]} and the file entries, indexed by file hash
+def get_pka_toc (f):
+    with stage('toc'):
+        package_entries, file_entries = read_pka_toc(f)
+    count('toc', entries = sum([len(x) for x in package_entries.values()]), bytes_read = f.tell())
+    return(package_entries, file_entries)
+
+def read_pka_toc (f):
     f.seek(0,0)
     # Check for proper file format
     pka_header, = struct.unpack("<I", f.read(4))
@@ -25,87 +32,416 @@ def get_pka_individual_file_contents (f):
         package_name, number_files = struct.unpack("<32sI", f.read(32+4))
         # Grab the names of all files in each individual .pkg archive as well as their hashes
         file_entries = []
-        for _ in range(number_files):
-            file_entry_name, file_entry_hash = struct.unpack("<64s32s", f.read(64+32))
+        for file_entry_name, file_entry_hash in struct.iter_unpack("<64s32s", f.read((64+32) * number_files)):
             file_entries.append([file_entry_name.rstrip(b"\x00"), file_entry_hash])
         package_entries[package_name.rstrip(b"\x00").decode("ASCII")] = file_entries
     total_file_entries, = struct.unpack("<I", f.read(4))
     # Grab the metadata of all files in the .pka file, indexed by file hashes
     file_entries = {}
-    for _ in range(total_file_entries):
-        file_entry_hash, file_entry_offset, file_entry_compressed_size, file_entry_uncompressed_size,\
-            file_entry_flags = struct.unpack("<32sQIII", f.read(32+8+4+4+4))
+    for file_entry_hash, file_entry_offset, file_entry_compressed_size, file_entry_uncompressed_size,\
+            file_entry_flags in struct.iter_unpack("<32sQIII", f.read((32+8+4+4+4) * total_file_entries)):
         file_entries[file_entry_hash] = [file_entry_offset, file_entry_compressed_size, file_entry_uncompressed_size, file_entry_flags]
-    all_files = [x+[y] for y in package_entries.keys() for x in package_entries[y]]
-    file_contents = []
-    for i in range(len(all_files)):
-        file_contents.append({"file_entry_name": all_files[i][0].decode('utf-8'),\
-            "file_entry_uncompressed_size": file_entries[all_files[i][1]][2],\
-            "file_entry_compressed_size": file_entries[all_files[i][1]][1],\
-            "file_entry_offset": file_entries[all_files[i][1]][0],\
-            "file_entry_flags": file_entries[all_files[i][1]][3],
-            "package_name": all_files[i][2]})
-    return(file_contents)
+    return(package_entries, file_entries)
+
+def make_pka_file_entry (file_entry_name, file_entry_metadata, package_name):
+    return({"file_entry_name": file_entry_name,\
+        "file_entry_uncompressed_size": file_entry_metadata[2],\
+        "file_entry_compressed_size": file_entry_metadata[1],\
+        "file_entry_offset": file_entry_metadata[0],\
+        "file_entry_flags": file_entry_metadata[3],
+        "package_name": package_name})
+
+#Note there WILL be duplicate entries - e.g. asset_D3D11.xml
+def get_pka_individual_file_contents (f):
+    package_entries, file_entries = get_pka_toc(f)
+    return([make_pka_file_entry(x[0].decode('utf-8'), file_entries[x[1]], y) for y in package_entries.keys() for x in package_entries[y]])
+
+# The .toc cache is a header (magic, version, PKA size and mtime, number of packages and of files), then the package
+# names, then one record per file name: name, hash, offset, compressed size, uncompressed size, flags and the
+# position of its package in the package names.  It is read with struct only, so a foreign .toc cannot run code.
+pka_toc_cache_version = 2
+pka_toc_cache_header = struct.Struct("<4sIQqII")
+pka_toc_cache_record = struct.Struct("<64s32sQIIII")
+
+# A PKA opened through the archive pool, with its TOC parsed once and indexed by file name.  The index holds one
+# entry per name, so a name found in more than one package (e.g. asset_D3D11.xml) is only indexed once, and
+# resolves to the first package, as in get_pka_individual_file_contents.
+# The name index is cached in a .toc file next to the PKA, keyed by the PKA's size and modification time, so the
+# TOC is only parsed again when the PKA changes.  The package lists and hash table are parsed on first use.
+class PkaArchive:
+    def __init__ (self, pka_filename, use_cache = True):
+        self.filename = pka_filename
+        self.f = open_archive(pka_filename)
+        pka_stat = os.stat(pka_filename)
+        self.key = [pka_stat.st_size, pka_stat.st_mtime_ns]
+        self.toc = None
+        if not (use_cache and self.load_cache()):
+            package_entries, file_entries = self.get_toc()
+            # Name -> (hash, offset, compressed size, uncompressed size, flags, package name) of the first occurrence
+            self.index = {}
+            for package_name in package_entries:
+                for file_entry_name, file_entry_hash in package_entries[package_name]:
+                    file_entry_name = file_entry_name.decode('utf-8')
+                    if file_entry_name not in self.index:
+                        self.index[file_entry_name] = tuple([file_entry_hash] + file_entries[file_entry_hash] + [package_name])
+            if use_cache:
+                self.save_cache()
+
+    def get_toc (self):
+        if self.toc is None:
+            self.toc = get_pka_toc(self.f)
+        return(self.toc)
+
+    @property
+    def package_entries (self):
+        return(self.get_toc()[0])
+
+    @property
+    def file_entries (self):
+        return(self.get_toc()[1])
+
+    def load_cache (self):
+        try:
+            with stage('toc cache'), open(self.filename + '.toc', 'rb') as f:
+                magic, version, size, mtime, number_packages, number_files =\
+                    pka_toc_cache_header.unpack(f.read(pka_toc_cache_header.size))
+                if magic != b'PKAT' or version != pka_toc_cache_version or [size, mtime] != self.key:
+                    return(False)
+                package_names = [x.rstrip(b"\x00").decode("ASCII") for x, in\
+                    struct.iter_unpack("<32s", f.read(32 * number_packages))]
+                data = f.read()
+                if len(package_names) != number_packages or len(data) != pka_toc_cache_record.size * number_files:
+                    return(False)
+                index = {}
+                for file_entry_name, file_entry_hash, file_entry_offset, file_entry_compressed_size,\
+                        file_entry_uncompressed_size, file_entry_flags, package_number in pka_toc_cache_record.iter_unpack(data):
+                    index[file_entry_name.rstrip(b"\x00").decode('utf-8')] = (file_entry_hash, file_entry_offset,\
+                        file_entry_compressed_size, file_entry_uncompressed_size, file_entry_flags, package_names[package_number])
+                count('toc cache', entries = len(index), bytes_read = f.tell())
+            self.index = index
+            return(True)
+        except (OSError, ValueError, IndexError, struct.error):
+            pass # Missing, truncated or foreign .toc, the TOC is parsed again
+        return(False)
+
+    def save_cache (self):
+        package_names = list(dict.fromkeys([x[5] for x in self.index.values()]))
+        package_numbers = {package_names[i]: i for i in range(len(package_names))}
+        try:
+            with open(self.filename + '.toc.tmp', 'wb') as f:
+                f.write(pka_toc_cache_header.pack(b'PKAT', pka_toc_cache_version, self.key[0], self.key[1],\
+                    len(package_names), len(self.index)))
+                f.write(b''.join([struct.pack("<32s", x.encode("ASCII")) for x in package_names]))
+                f.write(b''.join([pka_toc_cache_record.pack(x.encode('utf-8'), *self.index[x][0:5],\
+                    package_numbers[self.index[x][5]]) for x in self.index]))
+            os.replace(self.filename + '.toc.tmp', self.filename + '.toc')
+        except OSError:
+            pass # Read-only folder, the TOC will just be parsed again next time
+
+    def __contains__ (self, file_entry_name):
+        return(file_entry_name in self.index)
+
+    # Exact name lookup, returns the entry (a new dict, in the format of get_pka_individual_file_contents) or False
+    def find (self, file_entry_name):
+        if file_entry_name in self.index:
+            return(make_pka_file_entry(file_entry_name, self.index[file_entry_name][1:5], self.index[file_entry_name][5]))
+        return(False)
+
+    # Content hash of an entry, as stored in the PKA
+    def get_hash (self, file_entry_name):
+        if file_entry_name in self.index:
+            return(self.index[file_entry_name][0])
+        return(False)
+
+    def read (self, file_entry, decompress = True):
+        return(retrieve_entry(self.f, file_entry, decompress))
 
 def find_file_in_pkg(file_to_find, list_of_pkgs_to_avoid = []):
     pkgs = [x for x in glob.glob('*.pkg') if x not in list_of_pkgs_to_avoid]
     match = False
     for i in range(len(pkgs)):
-        with open(pkgs[i],'rb') as f:
-            file_contents = [x["file_entry_name"] for x in get_pkg_contents(f)]
-            if file_to_find in file_contents:
-                match = pkgs[i]
-                break
+        if file_to_find in PkgArchive(pkgs[i]):
+            match = pkgs[i]
+            break
     return(match)
 
-# Shaders can be pulled from either a PKA or the current folder can be searched
-def replace_shaders_in_pkg(pkg_filename, new_pkg_filename, pka_filename = False):
+# Maps the name of every shader (fx#) in the .pkg files of the current folder to [absolute path, entry] of each
+# package that contains it, in the same order that find_file_in_pkg searches them.  Built once per run, so that
+# each shader lookup is a dictionary access instead of opening every package.
+def build_shader_index(list_of_pkgs_to_avoid = []):
+    shader_index = {}
+    with stage('shader index'):
+        for pkg_filename in [x for x in glob.glob('*.pkg') if x not in list_of_pkgs_to_avoid]:
+            pkg = PkgArchive(pkg_filename, pkg_filename)
+            for file_entry_name in pkg.index:
+                if 'fx#' in file_entry_name:
+                    shader_index.setdefault(file_entry_name, []).append([os.path.abspath(pkg_filename), pkg.find(file_entry_name)])
+    count('shader index', entries = len(shader_index))
+    return(shader_index)
+
+# Returns [path, entry] of the first package in the index with this shader, skipping the packages to avoid
+def find_shader_in_index(shader_index, file_to_find, list_of_pkgs_to_avoid = []):
+    pkgs_to_avoid = [os.path.abspath(x) for x in list_of_pkgs_to_avoid]
+    for pkg_path, file_entry in shader_index.get(file_to_find, []):
+        if pkg_path not in pkgs_to_avoid:
+            return([pkg_path, file_entry])
+    return(False)
+
+# Returns the plan (see write_pkg_plan) to rebuild pkg_filename with new shaders, and whether any shader was not
+# found.  pka is a PkaArchive, or False to use the shader_index of the current folder.
+def plan_shader_replacement(pkg_filename, list_of_pkgs_to_avoid, pka = False, shader_index = None):
     missing_shaders = False
-    using_pka = False
-    if pka_filename != False:
-        asset_f = open(pka_filename, 'rb')
-        using_pka = True
-        archive_files = get_pka_individual_file_contents(asset_f)
-    else:
-        archive_files = []
-    with open(pkg_filename, 'rb') as f:
-        file_contents = get_pkg_contents(f)
-        new_file_contents = []
-        new_file_stream = io.BytesIO()
-        for i in range(len(file_contents)):
-            if 'fx#' in file_contents[i]["file_entry_name"]:
-                if not using_pka:
-                    file_match = find_file_in_pkg(file_contents[i]["file_entry_name"],\
-                        list_of_pkgs_to_avoid = [pkg_filename, new_pkg_filename]) # We don't want the old shader!
-                    if file_match != False:
-                        asset_f = open(file_match, 'rb')
-                        archive_files = get_pkg_contents(asset_f, file_match)
-                shader_entries = [x for x in archive_files if file_contents[i]["file_entry_name"] == x["file_entry_name"]]
-                if len(shader_entries) > 0:
-                    print("Shader {0} found, replacing from {1}...".format(file_contents[i]["file_entry_name"],\
-                        shader_entries[0]["package_name"]))
-                    file = retrieve_file (asset_f, shader_entries[0]["file_entry_name"], archive_files, decompress = False)
-                    new_file_contents = insert_file_into_stream (new_file_stream, new_file_contents, file,\
-                        shader_entries[0]) # Offset will be fixed at time of packing
-                    if not using_pka:
-                        asset_f.close()
+    pkg = PkgArchive(pkg_filename)
+    plan = []
+    for file_entry in pkg:
+        if 'fx#' in file_entry["file_entry_name"]:
+            shader_entry = False
+            with stage('search'):
+                if pka != False:
+                    shader_entry = pka.find(file_entry["file_entry_name"])
                 else:
-                    print("Shader {0} not found, including original...".format(file_contents[i]["file_entry_name"]))
-                    file = retrieve_file (f, file_contents[i]["file_entry_name"], file_contents, decompress = False)
-                    new_file_contents = insert_file_into_stream (new_file_stream, new_file_contents, file, file_contents[i])
-                    missing_shaders = True
+                    file_match = find_shader_in_index(shader_index, file_entry["file_entry_name"],\
+                        list_of_pkgs_to_avoid = list_of_pkgs_to_avoid) # We don't want the old shader!
+                    if file_match != False:
+                        file_match, shader_entry = file_match
+            count('search', entries = 1)
+            if shader_entry != False:
+                print("Shader {0} found, replacing from {1}...".format(file_entry["file_entry_name"],\
+                    shader_entry["package_name"]))
+                plan.append([shader_entry, file_span(pka.filename if pka != False else file_match, shader_entry)])
             else:
-                file = retrieve_file (f, file_contents[i]["file_entry_name"], file_contents, decompress = False)
-                new_file_contents = insert_file_into_stream (new_file_stream, new_file_contents, file, file_contents[i])
-        write_pkg_file (new_pkg_filename, new_file_stream, new_file_contents, magic = b'\x00\x00\x00\x00')
-    if using_pka == True:
-        asset_f.close()
+                print("Shader {0} not found, including original...".format(file_entry["file_entry_name"]))
+                plan.append([file_entry, file_span(pkg_filename, file_entry)])
+                missing_shaders = True
+        else:
+            plan.append([file_entry, file_span(pkg_filename, file_entry)])
+    return(plan, missing_shaders)
+
+# Returns True if writing the plan would change the package, comparing the entries and the stored bytes of
+# every replaced shader (the PKA hashes cannot be computed for package entries, so the contents are compared
+# directly through the mapped archives).  Also True if the package is not laid out as write_pkg_plan writes it.
+def plan_changes_pkg(pkg_filename, plan):
+    pkg = PkgArchive(pkg_filename)
+    if pkg.f[0:4] != b'\x00\x00\x00\x00' or len(pkg) != len(plan):
+        return(True)
+    file_entry_offset = len(plan) * 80 + 8
+    pkg_path = os.path.abspath(pkg_filename)
+    for file_entry, (details, span) in zip(pkg, plan):
+        if file_entry["file_entry_offset"] != file_entry_offset:
+            return(True)
+        for key in ["file_entry_name", "file_entry_uncompressed_size", "file_entry_compressed_size", "file_entry_flags"]:
+            if details[key] != file_entry[key]:
+                return(True)
+        # An entry kept from the package itself is the same bytes, only replaced shaders need to be compared
+        if not (os.path.abspath(span[0]) == pkg_path and span[1:] == file_span(pkg_filename, file_entry)[1:])\
+                and read_span(*span) != read_span(*file_span(pkg_filename, file_entry)):
+            return(True)
+        file_entry_offset += file_entry["file_entry_compressed_size"]
+    return(file_entry_offset != os.path.getsize(pkg_filename))
+
+# Shaders can be pulled from either a PKA or the current folder can be searched.  When searching the folder,
+# a shader_index from build_shader_index can be passed in to be shared between calls.
+def replace_shaders_in_pkg(pkg_filename, new_pkg_filename, pka_filename = False, shader_index = None):
+    pka, shader_index = get_shader_sources(pka_filename, shader_index)
+    plan, missing_shaders = plan_shader_replacement(pkg_filename, [pkg_filename, new_pkg_filename], pka, shader_index)
+    write_pkg_plan (new_pkg_filename, plan, magic = b'\x00\x00\x00\x00')
     return(missing_shaders)
 
+# The PkaArchive (or False) and shader index to search, from the pka_filename and shader_index arguments above
+def get_shader_sources(pka_filename = False, shader_index = None):
+    pka = False
+    if pka_filename != False:
+        # A PkaArchive can be passed in instead of a filename, to share the parsed TOC between calls
+        pka = pka_filename if isinstance(pka_filename, PkaArchive) else PkaArchive(pka_filename)
+    elif shader_index is None:
+        shader_index = build_shader_index()
+    return(pka, shader_index)
+
+# Incremental version of making a backup and calling replace_shaders_in_pkg.  The package is only backed up and
+# rewritten if its shaders do not already match the replacements.  Returns whether any shader was not found, and
+# whether the package was rewritten.
+def update_shaders_in_pkg(pkg_filename, backup_filename, pka_filename = False, shader_index = None):
+    missing_shaders, plan = plan_shader_update(pkg_filename, backup_filename, pka_filename, shader_index)
+    if plan is None:
+        return(missing_shaders, False)
+    write_pkg_plan (pkg_filename, plan, magic = b'\x00\x00\x00\x00')
+    return(missing_shaders, True)
+
+# update_shaders_in_pkg up to the writing.  Returns whether any shader was not found, and the plan to write to
+# pkg_filename, or None if the package is left untouched (and then it is not backed up either).
+def plan_shader_update(pkg_filename, backup_filename, pka_filename = False, shader_index = None):
+    pka, shader_index = get_shader_sources(pka_filename, shader_index)
+    plan, missing_shaders = plan_shader_replacement(pkg_filename, [pkg_filename, backup_filename], pka, shader_index)
+    with stage('compare'):
+        changes_pkg = plan_changes_pkg(pkg_filename, plan)
+    if not changes_pkg:
+        print("Shaders already up to date, {0} left untouched.".format(os.path.basename(pkg_filename)))
+        return(missing_shaders, None)
+    backup_file(pkg_filename, backup_filename)
+    return(missing_shaders, plan)
+
+# Mass replacement, used by both the .pka mode and the folder mode.  pkg_files are the names without .pkg,
+# and prefix is the path to the folder that holds them.  Returns the names of the packages with missing shaders,
+# and the names of the packages left untouched in incremental mode.
+def replace_shaders_in_pkgs(pkg_files, pka = False, shader_index = None, prefix = '', jobs = 1, incremental = False,\
+        change_plan = None, pipelined = False):
+    pkgs_with_missing_shaders = []
+    untouched_pkgs = []
+    if jobs == 1 or change_plan is not None or pipelined: # Planning only reads the TOCs, and is always done in this process
+        jobs = 1
+        if pipelined and change_plan is None and not shader_sources_include(pka, shader_index, [prefix + x for x in pkg_files]):
+            # The next package is planned while the previous one is written, and the results are kept for below
+            results = []
+            write_pkg_plans_pipelined(plan_shader_rewrites(results, [prefix + x for x in pkg_files], pka, shader_index,\
+                incremental))
+            results = iter(results)
+        else:
+            results = (replace_shaders_job(prefix + x, pka, shader_index, incremental, change_plan = change_plan) for x in pkg_files)
+    else:
+        import concurrent.futures
+        # Each worker opens the PKA itself (memory-mapped, with the TOC from the .toc cache) or receives the shader
+        # index once, then the output of every package is printed in the original order.
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs if jobs > 0 else None,\
+            initializer = init_replace_shaders_worker,\
+            initargs = (pka.filename if pka != False else False, shader_index, incremental))
+        results = pool_results(executor.map(pool_job(replace_shaders_worker_job), [prefix + x for x in pkg_files]))
+    try:
+        for i in range(len(pkg_files)):
+            output, result, rewritten = next(results)
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if result == True:
+                pkgs_with_missing_shaders.append(pkg_files[i])
+            if rewritten == False:
+                untouched_pkgs.append(pkg_files[i])
+    finally:
+        if jobs != 1:
+            executor.shutdown()
+    return(pkgs_with_missing_shaders, untouched_pkgs)
+
+# Backs up and patches a single package of a mass replacement, or adds it to change_plan.  When capture_output is
+# set, the output is returned instead of printed, along with the result of replace_shaders_in_pkg and whether the
+# package was (or would be) rewritten.
+def replace_shaders_job(pkg_file, pka = False, shader_index = None, incremental = False, capture_output = False,\
+        change_plan = None):
+    output = io.StringIO()
+    with (contextlib.redirect_stdout(output) if capture_output else contextlib.nullcontext()):
+        print("\r\nProcessing {}.pkg...".format(os.path.basename(pkg_file)))
+        if change_plan is not None:
+            result, rewritten = plan_shaders_in_pkg(change_plan, pkg_file + '.pkg', pkg_file + '.pkg.bak', pka,\
+                shader_index, incremental)
+        elif incremental:
+            result, rewritten = update_shaders_in_pkg(pkg_file + '.pkg', pkg_file + '.pkg.bak', pka, shader_index)
+        else:
+            backup_file(pkg_file + '.pkg', pkg_file + '.pkg.bak')
+            result = replace_shaders_in_pkg(pkg_file + '.pkg.bak', pkg_file + '.pkg', pka, shader_index)
+            rewritten = True
+    return(output.getvalue(), result, rewritten)
+
+# Whether the shaders may be taken from the packages being rewritten.  A pipelined replacement plans the next
+# package while the previous one is written, so its plan would copy spans from the old layout of a package that
+# has already been replaced; such runs are done one package after the other instead.
+def shader_sources_include(pka, shader_index, pkg_files):
+    if pka != False:
+        return(False)
+    if shader_index is None: # The index is built from the current folder for every package
+        return(True)
+    pkg_paths = set([os.path.abspath(x + '.pkg') for x in pkg_files])
+    return(any([pkg_path in pkg_paths for matches in shader_index.values() for pkg_path, file_entry in matches]))
+
+# Backs up and plans each package of a pipelined mass replacement (see write_pkg_plans_pipelined), printing the
+# same output as replace_shaders_job.  Its results are appended to results.
+def plan_shader_rewrites(results, pkg_files, pka = False, shader_index = None, incremental = False):
+    for pkg_file in pkg_files:
+        print("\r\nProcessing {}.pkg...".format(os.path.basename(pkg_file)))
+        if incremental:
+            result, plan = plan_shader_update(pkg_file + '.pkg', pkg_file + '.pkg.bak', pka, shader_index)
+        else:
+            backup_file(pkg_file + '.pkg', pkg_file + '.pkg.bak')
+            plan, result = plan_shader_replacement(pkg_file + '.pkg.bak', [pkg_file + '.pkg.bak', pkg_file + '.pkg'],\
+                *get_shader_sources(pka, shader_index))
+        results.append(['', result, plan is not None])
+        if plan is not None:
+            yield([pkg_file + '.pkg', plan, b'\x00\x00\x00\x00'])
+
+replace_shaders_worker_state = {"pka": False, "shader_index": None, "incremental": False}
+
+def init_replace_shaders_worker(pka_filename, shader_index, incremental):
+    if pka_filename != False:
+        replace_shaders_worker_state["pka"] = PkaArchive(pka_filename)
+    replace_shaders_worker_state["shader_index"] = shader_index
+    replace_shaders_worker_state["incremental"] = incremental
+
+def replace_shaders_worker_job(pkg_file):
+    return(replace_shaders_job(pkg_file, replace_shaders_worker_state["pka"], replace_shaders_worker_state["shader_index"],\
+        replace_shaders_worker_state["incremental"], capture_output = True))
+
+# Adds one package to a change plan (see save_change_plan in aa_inject_model.py), without writing anything.
+# Same arguments as update_shaders_in_pkg, except that pka must already be a PkaArchive or False.
+def plan_shaders_in_pkg(change_plan, pkg_filename, backup_filename, pka = False, shader_index = None, incremental = False):
+    plan, missing_shaders = plan_shader_replacement(pkg_filename, [pkg_filename, backup_filename], pka, shader_index)
+    if incremental and not plan_changes_pkg(pkg_filename, plan):
+        print("Shaders already up to date, {0} left untouched.".format(os.path.basename(pkg_filename)))
+        return(missing_shaders, False)
+    changes, new_size = describe_pkg_plan(pkg_filename, plan, change_plan["base_dir"])
+    for change in changes:
+        if change["source"] not in change_plan["sources"]:
+            change_plan["sources"][change["source"]] = get_file_key(os.path.join(change_plan["base_dir"], change["source"]))
+    change_plan["packages"].append({"package": os.path.relpath(pkg_filename, change_plan["base_dir"]),\
+        "backup": os.path.relpath(backup_filename, change_plan["base_dir"]), "key": get_file_key(pkg_filename),\
+        "new_size": new_size, "changes": changes,\
+        "missing_shaders": [x["file_entry_name"] for x in PkgArchive(pkg_filename) if 'fx#' in x["file_entry_name"]\
+            and not x["file_entry_name"] in [y["name"] for y in changes]]})
+    return(missing_shaders, True)
+
+# Executes a change plan made with --plan, from the folder it was made in.  Returns the names of the packages
+# with missing shaders.
+def execute_shader_change_plan(plan_filename):
+    change_plan = load_change_plan(plan_filename, 'aa_replace_shaders')
+    pkgs_with_missing_shaders = []
+    for package in change_plan["packages"]:
+        print("\r\nProcessing {}...".format(package["package"]))
+        backup_file(package["package"], package["backup"])
+        for change in package["changes"]:
+            print("Shader {0} found, replacing from {1}...".format(change["name"], change.get("package_name", change["source"])))
+        for file_entry_name in package["missing_shaders"]:
+            print("Shader {0} not found, including original...".format(file_entry_name))
+        plan = pkg_plan_from_changes(package["backup"], package["changes"])
+        write_pkg_plan (package["package"], plan, magic = b'\x00\x00\x00\x00')
+        if len(package["missing_shaders"]) > 0:
+            pkgs_with_missing_shaders.append(os.path.basename(package["package"])[:-4])
+    return(pkgs_with_missing_shaders)
+
+def report_missing_shaders(pkgs_with_missing_shaders):
+    if len(pkgs_with_missing_shaders) > 0:
+        print("\r\nWarning! Shader replacement was not successful in the following .pkg files: {}.".format([x.upper()+'.pkg' for x in pkgs_with_missing_shaders]))
+        input("Press Enter to continue.")
+
 if __name__ == "__main__":
     # Set current directory
     os.chdir(os.path.abspath(os.path.dirname(__file__)))
 
+    # Number of packages to patch in parallel in mass replacement mode (0 is one per CPU)
+    jobs = int(pop_value_argument(sys.argv, ['-j', '--jobs'], 1))
+    # Only back up and rewrite packages whose shaders do not already match the replacements
+    incremental = pop_flag_argument(sys.argv, ['-i', '--incremental'])
+    # Plan the next package while one is written, in one process (see write_pkg_plans_pipelined), instead of --jobs
+    pipelined = pop_flag_argument(sys.argv, ['--pipeline'])
+    # Write the changes that would be made to a JSON change plan instead of making them, or execute such a plan
+    plan_filename = pop_value_argument(sys.argv, ['--plan'])
+    if plan_filename is not None:
+        plan_filename = os.path.abspath(plan_filename) # Folder mode changes the current directory
+    execute_plan_filename = pop_value_argument(sys.argv, ['--execute-plan'])
+    # Report the time and I/O of each stage at the end, e.g. --stats or --stats-json stats.json
+    pop_stats_arguments(sys.argv)
+    change_plan = None
+    if plan_filename is not None:
+        change_plan = {"version": change_plan_version, "tool": 'aa_replace_shaders', "base_dir": os.getcwd(),\
+            "packages": [], "sources": {}}
+    if execute_plan_filename is not None:
+        report_missing_shaders(execute_shader_change_plan(execute_plan_filename))
+        sys.exit()
+
     # Determine the assets.pka filename, use the first argument as default
     try:
         asset_file = sys.argv[1].lower()
@@ -143,36 +479,58 @@ if __name__ == "__main__":
 
     # Patch model into target
     pkgs_with_missing_shaders = []
+    untouched_pkgs = []
     if (not asset_file == False) and targetfile == '':
         pkg_files = [os.path.basename(x).lower().split('.pkg')[0] for x in glob.glob('*.pkg')]
         if asset_file.lower()[-4:] == '.pka': # Mass replace with .pka mode
-            for i in range(len(pkg_files)):
-                print("\r\nProcessing {}.pkg...".format(pkg_files[i]))
-                shutil.copy2(pkg_files[i] + '.pkg', pkg_files[i] + '.pkg.bak')
-                result = replace_shaders_in_pkg(pkg_files[i] + '.pkg.bak', pkg_files[i] + '.pkg', asset_file)
-                if result == True:
-                    pkgs_with_missing_shaders.append(pkg_files[i])
+            pka = PkaArchive(asset_file)
+            pkgs_with_missing_shaders, untouched_pkgs = replace_shaders_in_pkgs(pkg_files, pka, jobs = jobs,\
+                incremental = incremental, change_plan = change_plan, pipelined = pipelined)
         elif os.path.exists(asset_file) and os.path.isdir(asset_file) and len(glob.glob(asset_file+'/*.pkg')) > 0: # Folder with .pkg files mode
             base_dir = os.getcwd()
             os.chdir(base_dir+'/'+asset_file)
-            for i in range(len(pkg_files)):
-                print("\r\nProcessing {}.pkg...".format(pkg_files[i]))
-                shutil.copy2('../'+pkg_files[i] + '.pkg', '../'+pkg_files[i] + '.pkg.bak')
-                result = replace_shaders_in_pkg('../'+pkg_files[i] + '.pkg.bak', '../'+pkg_files[i] + '.pkg', False)
-                if result == True:
-                    pkgs_with_missing_shaders.append(pkg_files[i])
+            shader_index = build_shader_index()
+            pkgs_with_missing_shaders, untouched_pkgs = replace_shaders_in_pkgs(pkg_files, False, shader_index,\
+                prefix = '../', jobs = jobs, incremental = incremental, change_plan = change_plan, pipelined = pipelined)
             os.chdir(base_dir)
     else:
-        # Make a target backup (prior backups will be overwritten)
-        shutil.copy2(targetfile + '.pkg', targetfile + '.pkg.bak')
-        if asset_file == False or asset_file.lower()[-4:] == '.pka':
-            result = replace_shaders_in_pkg(targetfile + '.pkg.bak', targetfile + '.pkg', asset_file)
-        elif os.path.exists(asset_file) and os.path.isdir(asset_file) and len(glob.glob(asset_file+'/*.pkg')) > 0:
-            base_dir = os.getcwd()
-            os.chdir(base_dir+'/'+asset_file)
-            result = replace_shaders_in_pkg('../'+targetfile + '.pkg.bak', '../'+targetfile + '.pkg', False)
+        if change_plan is not None or incremental:
+            # Only makes a target backup if the target is going to be rewritten
+            if asset_file == False or asset_file.lower()[-4:] == '.pka':
+                if change_plan is not None:
+                    result, rewritten = plan_shaders_in_pkg(change_plan, targetfile + '.pkg', targetfile + '.pkg.bak',\
+                        PkaArchive(asset_file) if asset_file != False else False,\
+                        build_shader_index() if asset_file == False else None, incremental)
+                else:
+                    result, rewritten = update_shaders_in_pkg(targetfile + '.pkg', targetfile + '.pkg.bak', asset_file)
+            elif os.path.exists(asset_file) and os.path.isdir(asset_file) and len(glob.glob(asset_file+'/*.pkg')) > 0:
+                base_dir = os.getcwd()
+                os.chdir(base_dir+'/'+asset_file)
+                if change_plan is not None:
+                    result, rewritten = plan_shaders_in_pkg(change_plan, '../'+targetfile + '.pkg', '../'+targetfile + '.pkg.bak',\
+                        False, build_shader_index(), incremental)
+                else:
+                    result, rewritten = update_shaders_in_pkg('../'+targetfile + '.pkg', '../'+targetfile + '.pkg.bak', False)
+            if rewritten == False:
+                untouched_pkgs.append(targetfile)
+        else:
+            # Make a target backup (prior backups will be overwritten)
+            backup_file(targetfile + '.pkg', targetfile + '.pkg.bak')
+            if asset_file == False or asset_file.lower()[-4:] == '.pka':
+                result = replace_shaders_in_pkg(targetfile + '.pkg.bak', targetfile + '.pkg', asset_file)
+            elif os.path.exists(asset_file) and os.path.isdir(asset_file) and len(glob.glob(asset_file+'/*.pkg')) > 0:
+                base_dir = os.getcwd()
+                os.chdir(base_dir+'/'+asset_file)
+                result = replace_shaders_in_pkg('../'+targetfile + '.pkg.bak', '../'+targetfile + '.pkg', False)
         if result == True:
             pkgs_with_missing_shaders.append(targetfile)
-    if len(pkgs_with_missing_shaders) > 0:
-        print("\r\nWarning! Shader replacement was not successful in the following .pkg files: {}.".format([x.upper()+'.pkg' for x in pkgs_with_missing_shaders]))
-        input("Press Enter to continue.")
+    if change_plan is not None:
+        save_change_plan(plan_filename, change_plan)
+        print("\r\nChange plan written to {0}: {1} .pkg file(s) to rewrite, {2} entries to replace, {3} bytes to back up, {4} bytes to write.".format(\
+            plan_filename, len(change_plan["packages"]), sum([len(x["changes"]) for x in change_plan["packages"]]),\
+            change_plan["bytes_to_back_up"], change_plan["bytes_to_write"]))
+        print("Shaders would be missing in {0} .pkg file(s).".format(len(pkgs_with_missing_shaders)))
+    if incremental:
+        print("\r\n{0} .pkg file(s) already had matching shaders and were left untouched.".format(len(untouched_pkgs)))
+    if change_plan is None:
+        report_missing_shaders(pkgs_with_missing_shaders)
@@ -0,0 +1,60 @@
+# Short library that keeps a small pool of open, memory-mapped archives (.bra, .pka, .pkg), so that entries
+# can be sliced straight out of the mapping instead of opening, seeking and reading the archive every time.
+# The least recently used archive is closed once more than max_open_archives are open.
+#
+# GitHub eArmada8/ed8_inject
+
+import os, io, mmap, collections, threading
+
+max_open_archives = 8
+open_archives = collections.OrderedDict() # Absolute path -> [mapping, size, mtime, inode, device]
+open_archives_lock = threading.Lock()
+
+def close_mapping (mapping):
+    try:
+        mapping.close()
+    except BufferError:
+        pass # Slices of this mapping are still in use, it will be closed once they are released
+
+# Returns a read-only mapping of the archive, which supports seek / read like a file, as well as slicing.
+# A mapping is reused as long as the archive's size, modification time, inode and device have not changed, so an
+# archive replaced by another file (e.g. with os.replace) is mapped again even if its size and mtime match.
+def open_archive (filename):
+    path = os.path.abspath(filename)
+    archive_stat = os.stat(path)
+    with open_archives_lock:
+        if path in open_archives:
+            if open_archives[path][1:] == [archive_stat.st_size, archive_stat.st_mtime_ns, archive_stat.st_ino,\
+                archive_stat.st_dev]:
+                open_archives.move_to_end(path)
+                return(open_archives[path][0])
+            close_mapping(open_archives.pop(path)[0])
+        if archive_stat.st_size > 0:
+            with open(path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            mapping = io.BytesIO(b'') # Empty files cannot be mapped
+        open_archives[path] = [mapping, archive_stat.st_size, archive_stat.st_mtime_ns, archive_stat.st_ino,\
+            archive_stat.st_dev]
+        while len(open_archives) > max_open_archives:
+            close_mapping(open_archives.popitem(last=False)[1][0])
+    return(mapping)
+
+# Returns a zero-copy memoryview of size bytes at offset in the archive
+def read_span (filename, offset, size):
+    mapping = open_archive(filename)
+    if isinstance(mapping, io.BytesIO):
+        return(mapping.getbuffer()[offset:offset+size])
+    return(memoryview(mapping)[offset:offset+size])
+
+# Must be called before overwriting or deleting an archive that may be in the pool
+def release_archive (filename):
+    path = os.path.abspath(filename)
+    with open_archives_lock:
+        if path in open_archives:
+            close_mapping(open_archives.pop(path)[0])
+
+def release_all_archives ():
+    with open_archives_lock:
+        while len(open_archives) > 0:
+            close_mapping(open_archives.popitem()[1][0])
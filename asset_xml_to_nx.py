@@ -1,55 +1,184 @@
 # Short script to patch a model with asset_nx.xml Falcom ED8 games.  It will create a backup,
 # and then it will attempt to replace asset_D3D11.xml with asset_NX.xml.
 #
-# Requires aa_inject_model.py and unpackpkg.py, put in the same directory
+# Requires aa_inject_model.py, archive_handles.py, pkg_compression.py, stage_stats.py and unpackpkg.py, put in the
+# same directory
 #
 # GitHub eArmada8/ed8_inject
 
-import sys, os, shutil, struct, io, glob
+import sys, os, shutil, struct, io, glob, functools
 import xml.etree.ElementTree as ET
+import xml.parsers.expat
 from aa_inject_model import *
 
-def convert_asset_xml (xml_binary):
+# Rewrites the attributes of the clusters (the elements two levels under the root) for NX
+def convert_cluster_attribute (name, value):
+    if name == 'path':
+        return(value.replace('data/D3D11', 'data/NX'))
+    elif name == 'type':
+        return(value.replace('p_fx', 'binary'))
+    return(value)
+
+# Original version of convert_asset_xml, which builds the whole ElementTree and writes it out again
+def convert_asset_xml_tree (xml_binary):
     with io.BytesIO(xml_binary) as f:
         asset_xml = ET.parse(f)
         root = asset_xml.getroot()
         for asset in root:
             for cluster in asset:
                 if 'path' in cluster.attrib:
-                    cluster.attrib['path'] = cluster.attrib['path'].replace('data/D3D11', 'data/NX')
+                    cluster.attrib['path'] = convert_cluster_attribute('path', cluster.attrib['path'])
                 if 'type' in cluster.attrib:
-                    cluster.attrib['type'] = cluster.attrib['type'].replace('p_fx', 'binary')
+                    cluster.attrib['type'] = convert_cluster_attribute('type', cluster.attrib['type'])
         with io.BytesIO() as f2:
             asset_xml.write(f2, encoding='utf-8', xml_declaration=True)
             f2.seek(0)
             xml_data = f2.read()
             return (xml_data)
 
-def replace_xml_in_pkg(pkg_filename, new_pkg_filename):
-    with open(pkg_filename, 'rb') as f:
-        file_contents = get_pkg_contents(f)
-        new_file_contents = []
-        new_file_stream = io.BytesIO()
-        for i in range(len(file_contents)):
-            if 'asset_D3D11' in file_contents[i]["file_entry_name"]:
-                    file = retrieve_file (f, file_contents[i]["file_entry_name"], file_contents, decompress = True)
-                    file = convert_asset_xml(file)
-                    file_contents[i]["file_entry_name"] = file_contents[i]["file_entry_name"].replace('D3D11','NX')
-                    file_contents[i]["file_entry_uncompressed_size"] = len(file)
-                    file_contents[i]["file_entry_compressed_size"] = len(file)
-                    file_contents[i]["file_entry_flags"] = 0
-                    new_file_contents = insert_file_into_stream (new_file_stream, new_file_contents, file, file_contents[i])
-            else:
-                file = retrieve_file (f, file_contents[i]["file_entry_name"], file_contents, decompress = False)
-                new_file_contents = insert_file_into_stream (new_file_stream, new_file_contents, file, file_contents[i])
-        write_pkg_file (new_pkg_filename, new_file_stream, new_file_contents, magic = b'\x00\x00\x00\x00')
+# Escaping as ElementTree writes text and attribute values (CR, LF and tab in attributes become character
+# references, so they are not normalized when read back)
+xml_cdata_escapes = [['&', '&amp;'], ['<', '&lt;'], ['>', '&gt;']]
+xml_attribute_escapes = xml_cdata_escapes + [['"', '&quot;'], ['\r', '&#13;'], ['\n', '&#10;'], ['\t', '&#09;']]
+
+def escape_xml (text, escapes):
+    for character, escape in escapes:
+        if character in text:
+            text = text.replace(character, escape)
+    return(text)
+
+# Streaming version of convert_asset_xml_tree.  The XML is read (and validated) by expat, and each element is
+# written out as soon as it is read, exactly as ElementTree would write it, without building a tree.  Namespaces
+# are not supported (ElementTree renames their prefixes), and raise ValueError.
+def stream_convert_asset_xml (xml_binary):
+    output = ["<?xml version='1.0' encoding='utf-8'?>\n"]
+    state = {"depth": 0, "start_tag_open": False} # start_tag_open: the last start tag is still missing its '>'
+    def close_start_tag ():
+        if state["start_tag_open"]:
+            output.append(">")
+            state["start_tag_open"] = False
+    def start_element (tag, attributes):
+        close_start_tag()
+        if ':' in tag:
+            raise ValueError("Namespaces are not supported")
+        output.append("<" + tag)
+        for i in range(0, len(attributes), 2):
+            name, value = attributes[i], attributes[i+1]
+            if ':' in name or name == 'xmlns':
+                raise ValueError("Namespaces are not supported")
+            if state["depth"] == 2:
+                value = convert_cluster_attribute(name, value)
+            output.append(" " + name + "=\"" + escape_xml(value, xml_attribute_escapes) + "\"")
+        state["start_tag_open"] = True
+        state["depth"] += 1
+    def end_element (tag):
+        state["depth"] -= 1
+        if state["start_tag_open"]:
+            output.append(" />") # ElementTree writes elements without text or children in short form
+            state["start_tag_open"] = False
+        else:
+            output.append("</" + tag + ">")
+    def character_data (data):
+        if state["depth"] > 0:
+            close_start_tag()
+            output.append(escape_xml(data, xml_cdata_escapes))
+    parser = xml.parsers.expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    parser.Parse(bytes(xml_binary), True)
+    return(''.join(output).encode('utf-8'))
+
+def convert_asset_xml (xml_binary):
+    with stage('convert'):
+        try:
+            new_xml_binary = stream_convert_asset_xml(xml_binary)
+        except (ValueError, xml.parsers.expat.ExpatError):
+            # Let ElementTree handle namespaces, or raise its usual error for invalid XML
+            new_xml_binary = convert_asset_xml_tree(xml_binary)
+    count('convert', entries = 1, bytes_read = len(xml_binary), bytes_written = len(new_xml_binary))
+    return(new_xml_binary)
+
+# Returns the plan (see write_pkg_plan) to rebuild pkg_filename with asset_NX.xml
+# The XML is stored uncompressed unless compression (see pkg_compression.py) is given.
+def plan_xml_replacement(pkg_filename, compression = 'none'):
+    return([resolve_plan_entry(x) for x in plan_xml_replacement_pipelined(pkg_filename, compression)])
+
+# The plan of plan_xml_replacement for write_pkg_plans_pipelined.  Only the stored bytes of the XML are read
+# here, and they are decompressed, converted and compressed again by convert_xml_entry in the transform stage.
+def plan_xml_replacement_pipelined(pkg_filename, compression = 'none'):
+    pkg = PkgArchive(pkg_filename)
+    plan = []
+    for file_entry in pkg:
+        if 'asset_D3D11' in file_entry["file_entry_name"]:
+            plan.append(functools.partial(convert_xml_entry, file_entry, bytes(pkg.read(file_entry, decompress = False)),\
+                compression))
+        else:
+            plan.append([file_entry, file_span(pkg_filename, file_entry)])
+    return(plan)
+
+def convert_xml_entry(file_entry, stored_data, compression = 'none'):
+    file = convert_asset_xml(decompress_stored_entry(file_entry, stored_data))
+    return(make_new_entry(file_entry["file_entry_name"].replace('D3D11','NX'), file, compression, file_entry["file_entry_flags"]))
+
+def replace_xml_in_pkg(pkg_filename, new_pkg_filename, compression = 'none', pipelined = False):
+    if pipelined:
+        write_pkg_plans_pipelined([[new_pkg_filename, plan_xml_replacement_pipelined(pkg_filename, compression),\
+            b'\x00\x00\x00\x00']])
+        return
+    write_pkg_plan (new_pkg_filename, plan_xml_replacement(pkg_filename, compression), magic = b'\x00\x00\x00\x00')
     return
 
-def process_pkg (pkg_name):
+def process_pkg (pkg_name, compression = 'none'):
     # Make a backup (prior backups will be overwritten)
-    shutil.copy2(pkg_name + '.pkg', pkg_name + '.pkg.bak')
+    backup_file(pkg_name + '.pkg', pkg_name + '.pkg.bak')
     # Patch xml into target
-    replace_xml_in_pkg(pkg_name + '.pkg.bak', pkg_name + '.pkg')
+    replace_xml_in_pkg(pkg_name + '.pkg.bak', pkg_name + '.pkg', compression)
+
+def process_pkg_job (job):
+    return(process_pkg(*job))
+
+# Backs up and plans each package of a pipelined batch, while the previous one is being written
+def plan_pkg_rewrites (pkg_names, compression = 'none'):
+    for pkg_name in pkg_names:
+        backup_file(pkg_name + '.pkg', pkg_name + '.pkg.bak')
+        yield([pkg_name + '.pkg', plan_xml_replacement_pipelined(pkg_name + '.pkg.bak', compression), b'\x00\x00\x00\x00'])
+
+# Processes several packages, in parallel if jobs is not 1 (0 is one process per CPU).  With pipelined, a single
+# process reads, converts and writes in overlapping stages instead (see write_pkg_plans_pipelined).
+def process_pkgs (pkg_names, jobs = 1, compression = 'none', pipelined = False):
+    if pipelined:
+        write_pkg_plans_pipelined(plan_pkg_rewrites(pkg_names, compression))
+    elif jobs == 1 or len(pkg_names) < 2:
+        for i in range(len(pkg_names)):
+            process_pkg(pkg_names[i], compression)
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers = jobs if jobs > 0 else None) as executor:
+            list(pool_results(executor.map(pool_job(process_pkg_job), [[x, compression] for x in pkg_names]))) # Raises the first error, if any
+    return
+
+# Adds a package to a change plan (see save_change_plan in aa_inject_model.py) instead of processing it.  The new
+# XML is not stored in the plan, it is converted again from the original when the plan is executed.
+def plan_pkg (change_plan, pkg_name, compression = 'none'):
+    changes, new_size = describe_pkg_plan(pkg_name + '.pkg', plan_xml_replacement(pkg_name + '.pkg', compression))
+    for change in changes:
+        if not "source" in change:
+            change["transform"] = "convert_asset_xml"
+            change["compression"] = compression
+    change_plan["packages"].append({"package": pkg_name + '.pkg', "backup": pkg_name + '.pkg.bak',\
+        "key": get_file_key(pkg_name + '.pkg'), "new_size": new_size, "changes": changes})
+    return
+
+def execute_xml_change_plan (plan_filename):
+    change_plan = load_change_plan(plan_filename, 'asset_xml_to_nx')
+    for package in change_plan["packages"]:
+        backup_file(package["package"], package["backup"])
+        plan = pkg_plan_from_changes(package["backup"], package["changes"], {"convert_asset_xml": convert_asset_xml})
+        write_pkg_plan (package["package"], plan, magic = b'\x00\x00\x00\x00')
+    return
 
 if __name__ == '__main__':
     # Set current directory
@@ -62,10 +191,37 @@ if __name__ == '__main__':
     if len(sys.argv) > 1:
         import argparse
         parser = argparse.ArgumentParser()
-        parser.add_argument('pkg_filename', help="Name of pkg file to export from (required).")
+        parser.add_argument('pkg_filename', nargs='?', help="Name of pkg file to export from (default: all pkg files).")
+        parser.add_argument('--plan', help="Write the changes to a JSON change plan instead of making them.")
+        parser.add_argument('--execute-plan', help="Make the changes in a JSON change plan written by --plan.")
+        parser.add_argument('--compress-xml', help="Store the new XML compressed: none (default), same, lz4, nislzss or zstd, optionally with a level, e.g. lz4:12", default='none')
+        parser.add_argument('-j', '--jobs', help="Number of packages to convert in parallel (default 1, 0 is one per CPU)", type=int, default=1)
+        parser.add_argument('--pipeline', help="Read, convert and write in overlapping stages in one process, instead of --jobs", action="store_true")
+        parser.add_argument('--stats', help="Report the time and I/O of each stage at the end", action="store_true")
+        parser.add_argument('--stats-json', help="Also save the stats to this .json file")
         args = parser.parse_args()
-        if os.path.exists(args.pkg_filename) and args.pkg_filename[-4:].lower() == '.pkg':
-            process_pkg(args.pkg_filename[:-4])
+        if args.stats or args.stats_json is not None:
+            start_stats(args.stats_json)
+        parse_compression(args.compress_xml)
+        if args.execute_plan is not None:
+            execute_xml_change_plan(args.execute_plan)
+        else:
+            if args.pkg_filename is not None:
+                pkg_files = [args.pkg_filename] if os.path.exists(args.pkg_filename)\
+                    and args.pkg_filename[-4:].lower() == '.pkg' else []
+            else:
+                pkg_files = [os.path.basename(x) for x in glob.glob('*.pkg')]
+            change_plan = {"version": change_plan_version, "tool": 'asset_xml_to_nx', "packages": [], "sources": {}}
+            if args.plan is not None:
+                for i in range(len(pkg_files)):
+                    plan_pkg(change_plan, pkg_files[i][:-4], args.compress_xml)
+            else:
+                process_pkgs([x[:-4] for x in pkg_files], args.jobs, args.compress_xml, args.pipeline)
+            if args.plan is not None:
+                save_change_plan(args.plan, change_plan)
+                print("Change plan written to {0}: {1} .pkg file(s) to rewrite, {2} entries to replace, {3} bytes to back up, {4} bytes to write.".format(\
+                    args.plan, len(change_plan["packages"]), sum([len(x["changes"]) for x in change_plan["packages"]]),\
+                    change_plan["bytes_to_back_up"], change_plan["bytes_to_write"]))
     else:
         pkg_files = glob.glob('*.pkg')
         for i in range(len(pkg_files)):
@@ -0,0 +1,550 @@
+# Benchmark script for the ed8_inject libraries.  It generates synthetic archives in a temporary folder, since
+# the real game archives cannot be shipped, and times the hot paths against the previous implementations.
+#
+# Requires aa_inject_model.py, asset_xml_to_nx.py, txe_file_extract.py, aa - decompresspkg.py, archive_handles.py,
+# pkg_compression.py, ed8_inject.py and unpackpkg.py, put in the same directory
+# Instructions: /path/to/python3 benchmark.py --help
+#
+# GitHub eArmada8/ed8_inject
+
+import os, sys, struct, io, zlib, time, tempfile, random, tracemalloc, contextlib, json
+
+# Synthetic archive generators
+
+# Text-like data that compresses reasonably, generated in blocks so that large files are quick to make
+def make_file_data (rng, size):
+    block = bytes(rng.choice(b'abcdefgh \n') for _ in range(min(size, 4096)))
+    blocks = [block[rng.randrange(len(block)):] + block for _ in range(size // max(len(block), 1) + 1)]
+    return(b''.join(blocks)[:size])
+
+# Binary data like a mesh: vertices as 32-bit floats on a smooth surface, then 16-bit triangle indices
+def make_model_data (rng, size):
+    vertex_count = size // 40
+    vertices = []
+    for i in range(vertex_count):
+        u, v = (i % 256) / 256, (i // 256) / 256
+        vertices += [round(u + rng.gauss(0, 0.01), 4), round(v + rng.gauss(0, 0.01), 4), round(u * v, 4),\
+            0.0, 0.0, 1.0, u, v]
+    indices = [(i // 3 + [0, 1, 256][i % 3] + rng.randrange(2)) % 65536 for i in range(vertex_count * 4)]
+    data = struct.pack('<{0}f'.format(len(vertices)), *vertices) + struct.pack('<{0}H'.format(len(indices)), *indices)
+    return(data[:size])
+
+def make_bra_file (filename, number_of_files = 1000, file_size = 256, seed = 0):
+    rng = random.Random(seed)
+    archive = bytearray(b'PDA\x00' + struct.pack('<3I', 1, 0, number_of_files))
+    directory = bytearray()
+    for i in range(number_of_files):
+        file_data = make_file_data(rng, file_size)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        compressed_data = compressor.compress(file_data) + compressor.flush()
+        file_name = 'asset\\dir{0}\\file{1:06d}.dat'.format(i % 16, i).encode()
+        directory += struct.pack('<IIIIHHI', 1600000000 + i, 0, len(compressed_data) + 16, len(file_data) + 16,\
+            len(file_name), 0, len(archive)) + file_name
+        archive += bytes(16) + compressed_data
+    struct.pack_into('<I', archive, 8, len(archive))
+    with open(filename, 'wb') as f:
+        f.write(archive + directory)
+    return(filename)
+
+# Stores an entry the way a .pkg or .pka does with the given flags: 1 NISLZSS, 4 lz4, 8 or 16 zstd, 0 uncompressed
+def encode_pkg_entry (data, flags = 0):
+    import pkg_compression
+    if flags & 1:
+        return(pkg_compression.compress_nislzss(data))
+    elif flags & 4:
+        return(pkg_compression.compress_lz4(data))
+    elif flags & 24:
+        return(pkg_compression.compress_zstd(data))
+    return(data)
+
+# A .pkg with number_of_files entries of file_size bytes, all stored with flags.  The first entry is
+# asset_D3D11.xml (asset_xml if given), and the last number_of_shaders entries are shaders (names with fx#).
+# The entry data is drawn from a pool of 16 payloads, so that compressed packages are quick to make.
+def make_pkg_file (filename, number_of_files = 1000, file_size = 256, seed = 0, flags = 0, number_of_shaders = 0,\
+        asset_xml = None):
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(min(number_of_files, 16)):
+        file_data = make_file_data(rng, file_size)
+        payloads.append([file_data, encode_pkg_entry(file_data, flags)])
+    toc = bytearray()
+    file_stream = bytearray()
+    data_offset = 8 + 80 * number_of_files
+    for i in range(number_of_files):
+        if i == 0:
+            file_name = b'asset_D3D11.xml'
+            file_data = make_file_data(rng, file_size) if asset_xml is None else asset_xml
+            stored_data = encode_pkg_entry(file_data, flags)
+        else:
+            if i >= number_of_files - number_of_shaders:
+                file_name = make_shader_name(number_of_files - i).encode()
+            else:
+                file_name = 'file{0:06d}.bin'.format(i).encode()
+            file_data, stored_data = payloads[i % len(payloads)]
+        toc += struct.pack("<64s4I", file_name.ljust(64, b'\x00'), len(file_data), len(stored_data),\
+            data_offset + len(file_stream), flags)
+        file_stream += stored_data
+    with open(filename, 'wb') as f:
+        f.write(b'\x00\x00\x00\x00' + struct.pack("<I", number_of_files) + toc + file_stream)
+    return(filename)
+
+def make_shader_name (i):
+    return('ed8_chr_{0:05d}.fx#{1:08x}'.format(i, i * 2654435761 % (1 << 32)))
+
+# A .pka holding number_of_packages packages of number_of_files entries each.  Each package includes the same
+# number_of_shaders shaders, which the PKA stores only once (by content hash) as the game archives do.
+def make_pka_file (filename, number_of_packages = 10, number_of_files = 100, file_size = 256, seed = 0, flags = 0,\
+        number_of_shaders = 0):
+    import hashlib
+    rng = random.Random(seed)
+    package_entries = []
+    stored_files = {} # Content hash -> [uncompressed size, stored data]
+    for i in range(number_of_packages):
+        file_entries = []
+        for j in range(number_of_files):
+            if j >= number_of_files - number_of_shaders:
+                file_name = make_shader_name(number_of_files - j)
+                file_data = make_file_data(random.Random(file_name), file_size)
+            else:
+                file_name = 'pkg{0:04d}_file{1:06d}.bin'.format(i, j)
+                file_data = make_file_data(rng, file_size)
+            file_hash = hashlib.sha256(file_data).digest()
+            if file_hash not in stored_files:
+                stored_files[file_hash] = [len(file_data), encode_pkg_entry(file_data, flags)]
+            file_entries.append([file_name.encode(), file_hash])
+        package_entries.append(['C_SYN{0:04d}.pkg'.format(i).encode(), file_entries])
+    header = bytearray(struct.pack("<II", 0x7FF7CF0D, len(package_entries)))
+    for package_name, file_entries in package_entries:
+        header += struct.pack("<32sI", package_name, len(file_entries))
+        for file_name, file_hash in file_entries:
+            header += struct.pack("<64s32s", file_name, file_hash)
+    header += struct.pack("<I", len(stored_files))
+    data_offset = len(header) + len(stored_files) * 52
+    file_stream = bytearray()
+    for file_hash in stored_files:
+        header += struct.pack("<32sQIII", file_hash, data_offset + len(file_stream), len(stored_files[file_hash][1]),\
+            stored_files[file_hash][0], flags)
+        file_stream += stored_files[file_hash][1]
+    with open(filename, 'wb') as f:
+        f.write(header + file_stream)
+    return(filename)
+
+# An asset XML like those in the character packages, with number_of_clusters D3D11 clusters
+def make_asset_xml (number_of_clusters = 1000, seed = 0):
+    rng = random.Random(seed)
+    clusters = []
+    for i in range(number_of_clusters):
+        cluster_type = rng.choice(['p_fx', 'texture', 'mesh', 'animation'])
+        clusters.append('    <cluster path="data/D3D11/{0}/file{1:05d}.{2}" type="{3}" size="{4}" />\n'.format(\
+            cluster_type, i, 'fx' if cluster_type == 'p_fx' else 'bin', cluster_type, rng.randrange(1 << 20)))
+    return(('<?xml version="1.0" encoding="utf-8"?>\n<assets>\n  <asset symbol="C_CHR000_C02" note="&amp; &lt;x&gt;">\n'\
+        + ''.join(clusters) + '  </asset>\n</assets>\n').encode('utf-8'))
+
+# Previous implementations, kept here as the baseline to compare against
+
+def legacy_get_filelist (archivefile):
+    with open(archivefile, 'rb') as f:
+        f.read(4)
+        compressionType, = struct.unpack('<I', f.read(4))
+        fileEntryOffset, = struct.unpack('<I', f.read(4))
+        fileCount, = struct.unpack('<I', f.read(4))
+        fileList = []
+        f.seek(fileEntryOffset)
+        for i in range(fileCount):
+            fileEntry = {}
+            fileEntry["fileNameOffset"] = f.tell()
+            fileEntry["filePackedTime"], = struct.unpack('<I', f.read(4))
+            fileEntry["unknown"], = struct.unpack('<I', f.read(4))
+            fileEntry["compressedSize"], = struct.unpack('<I', f.read(4))
+            fileEntry["uncompressedSize"], = struct.unpack('<I', f.read(4))
+            fileEntry["fileNameLength"], = struct.unpack('<H', f.read(2))
+            fileEntry["fileFlags"], = struct.unpack('<H', f.read(2))
+            fileEntry["fileOffset"], = struct.unpack('<I', f.read(4))
+            fileEntry["fileNameEntry"] = f.read(fileEntry["fileNameLength"]).decode('ascii','ignore').encode()
+            if (fileEntry["fileNameEntry"].find(b'\x00') >= 0):
+                fileEntry["fileNameEntry"] = fileEntry["fileNameEntry"][:fileEntry["fileNameEntry"].find(b'\x00')]
+            fileEntry["fileName"] = fileEntry["fileNameEntry"][fileEntry["fileNameEntry"].rfind(b'\\')+1:]
+            if (fileEntry["fileNameEntry"].rfind(b'\\') >= 0):
+                fileEntry["dirName"] = fileEntry["fileNameEntry"][:fileEntry["fileNameEntry"].rfind(b'\\')]
+            else:
+                fileEntry["dirName"] = ''
+            fileEntry["archiveName"] = archivefile
+            fileList.append(fileEntry)
+    return(fileList)
+
+def legacy_get_pkg_contents (f, package_name = ''):
+    f.seek(0,0)
+    file_contents = []
+    magic = f.read(4)
+    total_files, = struct.unpack("<I", f.read(4))
+    for i in range(total_files):
+        file = {}
+        file["file_entry_name"], file["file_entry_uncompressed_size"],\
+            file["file_entry_compressed_size"], file["file_entry_offset"],\
+            file["file_entry_flags"] = struct.unpack("<64s4I", f.read(80))
+        file["file_entry_name"] = file["file_entry_name"].rstrip(b"\x00").decode('utf-8')
+        file["package_name"] = package_name
+        file_contents.append(file)
+    return(file_contents)
+
+# The whole package in memory, as "aa - decompresspkg.py" did before it streamed the entries
+def legacy_decompress_pkg (pkg_filename, new_pkg_filename):
+    import pkg_compression
+    with open(pkg_filename, 'rb') as f:
+        source_file_data = bytearray(f.read())
+        f.seek(4)
+        package_file_entries = []
+        total_file_entries, = struct.unpack("<I", f.read(4))
+        for i in range(total_file_entries):
+            file_entry_name, file_entry_uncompressed_size, file_entry_compressed_size, file_entry_offset, file_entry_flags = struct.unpack("<64sIIII", f.read(80))
+            package_file_entries.append([file_entry_offset, file_entry_compressed_size, file_entry_uncompressed_size, file_entry_flags])
+        patched_header = source_file_data[0:package_file_entries[0][0]]
+        package_archive = bytes()
+        new_header_data = []
+        current_offset = package_file_entries[0][0]
+        for file_entry in package_file_entries:
+            f.seek(file_entry[0])
+            if file_entry[3] & 2:
+                f.seek(4, io.SEEK_CUR)
+            if file_entry[3] & 4:
+                output_data = pkg_compression.uncompress_lz4(f, file_entry[2], file_entry[1])
+            elif file_entry[3] & 24:
+                output_data = pkg_compression.uncompress_zstd(f, file_entry[2], file_entry[1])
+            elif file_entry[3] & 1:
+                output_data = pkg_compression.uncompress_nislzss(f, file_entry[2], file_entry[1])
+            else:
+                output_data = f.read(file_entry[2])
+            new_header_data.append([current_offset, len(output_data), len(output_data), 0])
+            package_archive = package_archive + output_data
+            current_offset = current_offset + len(output_data)
+    for offset in range(len(new_header_data)):
+        offset_location = (offset+1)*80-8
+        patched_header[offset_location:offset_location+16] = struct.pack("<4I", new_header_data[offset][1],\
+            new_header_data[offset][2], new_header_data[offset][0], new_header_data[offset][3])
+    with open(new_pkg_filename, 'wb') as f:
+        f.write(patched_header + package_archive)
+
+# Timing helpers
+
+def time_function (function, *args, repeat = 3):
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function(*args)
+        elapsed_time = time.perf_counter() - start_time
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+    return(best_time, result)
+
+# Returns the time and the peak Python memory allocation of a single call
+def measure_memory (function, *args):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    result = function(*args)
+    elapsed_time = time.perf_counter() - start_time
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return(elapsed_time, peak_memory, result)
+
+# Times a function on its own, for the hot paths that have no previous implementation to compare against.
+# size is the number of bytes the function processes, to report the throughput.
+def measure (name, function, *args, repeat = 3, size = None):
+    elapsed_time, result = time_function(function, *args, repeat = repeat)
+    if size is None:
+        print("{0}: {1:.4f}s".format(name, elapsed_time))
+    else:
+        print("{0}: {1:.4f}s, {2:.1f} MB/s".format(name, elapsed_time,\
+            size / 1048576 / elapsed_time if elapsed_time > 0 else float('inf')))
+    return({"benchmark": name, "time": elapsed_time, "size": size})
+
+# Runs a function in another folder with its output discarded, for the scripts that work on the current folder
+def run_quietly_in (folder, function, *args, **kwargs):
+    current_folder = os.getcwd()
+    os.chdir(folder)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return(function(*args, **kwargs))
+    finally:
+        os.chdir(current_folder)
+
+def compare (name, legacy_function, new_function, *args, repeat = 3):
+    legacy_time, legacy_result = time_function(legacy_function, *args, repeat = repeat)
+    new_time, new_result = time_function(new_function, *args, repeat = repeat)
+    if legacy_result != new_result:
+        raise Exception('Error: {0} results do not match the previous implementation!'.format(name))
+    print("{0}: previous {1:.4f}s, current {2:.4f}s, speedup {3:.2f}x".format(name, legacy_time, new_time,\
+        legacy_time / new_time if new_time > 0 else float('inf')))
+    return({"benchmark": name, "previous": legacy_time, "current": new_time})
+
+def benchmark_toc_parsing (work_dir, number_of_files, repeat = 3):
+    import txe_file_extract
+    from aa_inject_model import get_pkg_contents
+    results = []
+    bra_file = make_bra_file(os.path.join(work_dir, 'synthetic.bra'), number_of_files, file_size = 16)
+    results.append(compare('get_filelist ({0} entries)'.format(number_of_files),\
+        legacy_get_filelist, txe_file_extract.get_filelist, bra_file, repeat = repeat))
+    pkg_file = make_pkg_file(os.path.join(work_dir, 'synthetic.pkg'), number_of_files, file_size = 16)
+    with open(pkg_file, 'rb') as f:
+        results.append(compare('get_pkg_contents ({0} entries)'.format(number_of_files),\
+            legacy_get_pkg_contents, get_pkg_contents, f, repeat = repeat))
+    return(results)
+
+def benchmark_streaming_extraction (work_dir, file_size):
+    import txe_file_extract
+    bra_file = make_bra_file(os.path.join(work_dir, 'large.bra'), 1, file_size = file_size)
+    file_entry = txe_file_extract.get_filelist(bra_file)[0]
+    def buffered_extraction (file_entry, output_filename):
+        with open(output_filename, 'wb') as f_out:
+            return(f_out.write(txe_file_extract.extract_filedata(file_entry)))
+    def streaming_extraction (file_entry, output_filename):
+        with open(output_filename, 'wb') as f_out:
+            return(txe_file_extract.extract_filedata_to(file_entry, f_out))
+    results = []
+    for name, function in [('buffered', buffered_extraction), ('streaming', streaming_extraction)]:
+        elapsed_time, peak_memory, result = measure_memory(function, file_entry, os.path.join(work_dir, name + '.dat'))
+        print("{0} extraction ({1} MB entry): {2:.4f}s, peak memory {3:.1f} MB".format(name,\
+            file_size // 1048576, elapsed_time, peak_memory / 1048576))
+        results.append({"benchmark": name + ' extraction', "time": elapsed_time, "peak_memory": peak_memory})
+    with open(os.path.join(work_dir, 'buffered.dat'), 'rb') as f1, open(os.path.join(work_dir, 'streaming.dat'), 'rb') as f2:
+        if f1.read() != f2.read():
+            raise Exception('Error: streaming extraction does not match buffered extraction!')
+    return(results)
+
+# The streaming decompression against the previous one, for every kind of compression.  That both write the same
+# packages is tested in tests/test_streaming.py.
+def benchmark_decompression (work_dir, number_of_files, file_size, repeat = 3):
+    import importlib
+    decompresspkg = importlib.import_module('aa - decompresspkg')
+    results = []
+    for flags in [0, 1, 4, 8, 16]:
+        try:
+            pkg_file = make_pkg_file(os.path.join(work_dir, 'decompress{0}.pkg'.format(flags)), number_of_files,\
+                file_size, flags = flags)
+        except ImportError as e:
+            print("Decompression (flags {0}): skipped, {1}".format(flags, e))
+            continue
+        def legacy_decompression (pkg_file):
+            legacy_decompress_pkg(pkg_file, pkg_file + '.legacy')
+        def streaming_decompression (pkg_file):
+            decompresspkg.decompress_pkg(pkg_file, pkg_file + '.streaming')
+        results.append(dict(compare('decompress_pkg (flags {0}, {1} entries)'.format(flags, number_of_files),\
+            legacy_decompression, streaming_decompression, pkg_file, repeat = repeat), size = os.path.getsize(pkg_file)))
+    return(results)
+
+# The streaming converter against the ElementTree one.  That both give the same bytes, including for the edge
+# cases of XML that the synthetic asset XML does not have, is tested in tests/test_xml_conversion.py.
+def benchmark_xml_conversion (number_of_clusters, repeat = 3):
+    from asset_xml_to_nx import convert_asset_xml_tree, stream_convert_asset_xml
+    return([compare('convert_asset_xml ({0} clusters)'.format(number_of_clusters),\
+        convert_asset_xml_tree, stream_convert_asset_xml, make_asset_xml(number_of_clusters), repeat = repeat)])
+
+# Compression level versus speed versus size, for an asset XML and for a model-sized payload
+def benchmark_compression (number_of_clusters, payload_size = 2097152,\
+        methods = ['lz4', 'lz4:4', 'lz4:9', 'lz4:12', 'nislzss', 'zstd:1', 'zstd', 'zstd:9', 'zstd:19']):
+    import pkg_compression
+    results = []
+    samples = [['asset XML', make_asset_xml(number_of_clusters)], ['model payload', make_model_data(random.Random(0), payload_size)]]
+    for sample_name, data in samples:
+        for method in methods:
+            elapsed_time, (compressed_data, flags) = time_function(pkg_compression.compress_entry, data, method, repeat = 1)
+            if flags == 0:
+                print("{0} ({1} KB), {2}: not available or not smaller".format(sample_name, len(data) // 1024, method))
+                continue
+            print("{0} ({1} KB), {2}: {3:.4f}s, {4} KB, {5:.1%} of original, {6:.1f} MB/s".format(sample_name,\
+                len(data) // 1024, method, elapsed_time, len(compressed_data) // 1024, len(compressed_data) / len(data),\
+                len(data) / 1048576 / elapsed_time if elapsed_time > 0 else float('inf')))
+            results.append({"benchmark": 'compression', "sample": sample_name, "method": method, "time": elapsed_time,\
+                "size": len(data), "compressed_size": len(compressed_data)})
+    return(results)
+
+# The hot paths of the scripts, on synthetic packages of number_of_files entries of file_size bytes
+def benchmark_hot_paths (work_dir, number_of_files, file_size, repeat = 3):
+    import txe_file_extract, asset_xml_to_nx
+    from aa_inject_model import get_pkg_contents, retrieve_file, inject_asset_symbol_into_pkg
+    from aa_replace_shaders import replace_shaders_in_pkg
+    results = []
+    number_of_shaders = number_of_files // 4
+    asset_xml = make_asset_xml(number_of_files)
+
+    # Reading packages with each kind of compression
+    for flags in [0, 1, 4, 8, 16]:
+        try:
+            pkg_file = make_pkg_file(os.path.join(work_dir, 'flags{0}.pkg'.format(flags)), number_of_files, file_size,\
+                flags = flags)
+        except ImportError as e:
+            print("Packages with flags {0}: skipped, {1}".format(flags, e))
+            continue
+        with open(pkg_file, 'rb') as f:
+            results.append(measure('get_pkg_contents (flags {0}, {1} entries)'.format(flags, number_of_files),\
+                get_pkg_contents, f, repeat = repeat))
+            file_contents = get_pkg_contents(f)
+            file_entries = file_contents[::max(len(file_contents) // 100, 1)]
+            def retrieve_files (f, file_entries, file_contents):
+                return(sum([len(retrieve_file(f, x["file_entry_name"], file_contents)) for x in file_entries]))
+            results.append(measure('retrieve_file (flags {0}, {1} entries)'.format(flags, len(file_entries)),\
+                retrieve_files, f, file_entries, file_contents, repeat = repeat,\
+                size = sum([x["file_entry_uncompressed_size"] for x in file_entries])))
+
+    # Shader replacement from a PKA, and from the other packages in the folder
+    pkg_folder = os.path.join(work_dir, 'shaders')
+    os.mkdir(pkg_folder)
+    target_pkg = make_pkg_file(os.path.join(pkg_folder, 'C_TARGET.pkg'), number_of_files, file_size, seed = 1,\
+        number_of_shaders = number_of_shaders, asset_xml = asset_xml)
+    make_pkg_file(os.path.join(pkg_folder, 'C_SHADERS.pkg'), number_of_shaders + 1, file_size, seed = 2,\
+        number_of_shaders = number_of_shaders)
+    pka_file = make_pka_file(os.path.join(work_dir, 'assets.pka'), 10, number_of_files, file_size,\
+        number_of_shaders = number_of_shaders)
+    new_pkg = os.path.join(work_dir, 'C_NEW.pkg')
+    results.append(measure('replace_shaders_in_pkg (PKA, {0} shaders)'.format(number_of_shaders), run_quietly_in,\
+        pkg_folder, replace_shaders_in_pkg, 'C_TARGET.pkg', new_pkg, pka_file, repeat = repeat,\
+        size = os.path.getsize(target_pkg)))
+    results.append(measure('replace_shaders_in_pkg (folder, {0} shaders)'.format(number_of_shaders), run_quietly_in,\
+        pkg_folder, replace_shaders_in_pkg, 'C_TARGET.pkg', new_pkg, repeat = repeat, size = os.path.getsize(target_pkg)))
+
+    # Injection, with a symbol of the same length (patched) and of a different length (rewritten)
+    for name, asset_symbol in [['patch', 'C_CHR999_C99'], ['rewrite', 'C_CHR999_C99_LONGER']]:
+        results.append(measure('inject_asset_symbol_into_pkg ({0})'.format(name), inject_asset_symbol_into_pkg,\
+            target_pkg, new_pkg, asset_symbol, repeat = repeat, size = os.path.getsize(target_pkg)))
+    results.append(measure('convert_asset_xml ({0} clusters)'.format(number_of_files), asset_xml_to_nx.convert_asset_xml,\
+        asset_xml, repeat = repeat, size = len(asset_xml)))
+
+    # TXe archives
+    bra_file = make_bra_file(os.path.join(work_dir, 'synthetic.bra'), number_of_files, file_size)
+    results.append(measure('get_filelist ({0} entries)'.format(number_of_files), txe_file_extract.get_filelist,\
+        bra_file, repeat = repeat))
+    extract_folder = os.path.join(work_dir, 'extracted')
+    os.mkdir(extract_folder)
+    for jobs in [1, 0]:
+        results.append(measure('extract_archive ({0} entries, jobs {1})'.format(number_of_files, jobs), run_quietly_in,\
+            extract_folder, txe_file_extract.extract_archive, bra_file, True, False, jobs, repeat = repeat,\
+            size = number_of_files * file_size))
+    return(results)
+
+# Rewriting a batch of packages one stage after the other and with write_pkg_plans_pipelined.  The results are
+# the hashes of the new packages, so compare() also checks that both write the same bytes.
+def benchmark_pipeline (work_dir, number_of_files, file_size, repeat = 3, number_of_packages = 8):
+    import hashlib, functools, asset_xml_to_nx
+    from aa_inject_model import write_pkg_plans_pipelined
+    from aa_replace_shaders import PkaArchive, replace_shaders_in_pkg, plan_shader_replacement
+    results = []
+    pipeline_folder = os.path.join(work_dir, 'pipeline')
+    os.mkdir(pipeline_folder)
+    number_of_shaders = number_of_files // 4
+    asset_xml = make_asset_xml(number_of_files * 10)
+    pkg_files = [make_pkg_file(os.path.join(pipeline_folder, 'C_PIPE{0}.pkg'.format(i)), number_of_files, file_size,\
+        seed = i, flags = 4 if i % 2 else 0, number_of_shaders = number_of_shaders, asset_xml = asset_xml)\
+        for i in range(number_of_packages)]
+    new_pkg_files = [x + '.new' for x in pkg_files]
+    pka = PkaArchive(make_pka_file(os.path.join(pipeline_folder, 'assets.pka'), 10, number_of_files, file_size,\
+        number_of_shaders = number_of_shaders))
+    size = sum([os.path.getsize(x) for x in pkg_files])
+    def hash_new_pkgs ():
+        return([hashlib.sha256(open(x, 'rb').read()).hexdigest() for x in new_pkg_files])
+    for compression in ['none', 'same']:
+        def convert_sequentially ():
+            for pkg_file, new_pkg_file in zip(pkg_files, new_pkg_files):
+                asset_xml_to_nx.replace_xml_in_pkg(pkg_file, new_pkg_file, compression)
+            return(hash_new_pkgs())
+        def convert_pipelined ():
+            write_pkg_plans_pipelined([x[1], asset_xml_to_nx.plan_xml_replacement_pipelined(x[0], compression),\
+                b'\x00\x00\x00\x00'] for x in zip(pkg_files, new_pkg_files))
+            return(hash_new_pkgs())
+        results.append(dict(compare('XML conversion ({0}), {1} packages'.format(compression, number_of_packages),\
+            convert_sequentially, convert_pipelined, repeat = repeat), method = compression, size = size))
+    def replace_sequentially ():
+        for pkg_file, new_pkg_file in zip(pkg_files, new_pkg_files):
+            replace_shaders_in_pkg(pkg_file, new_pkg_file, pka)
+        return(hash_new_pkgs())
+    def replace_pipelined ():
+        write_pkg_plans_pipelined([x[1], plan_shader_replacement(x[0], list(x), pka)[0], b'\x00\x00\x00\x00']\
+            for x in zip(pkg_files, new_pkg_files))
+        return(hash_new_pkgs())
+    results.append(dict(compare('shader replacement (PKA), {0} packages'.format(number_of_packages),\
+        functools.partial(run_quietly_in, pipeline_folder, replace_sequentially),\
+        functools.partial(run_quietly_in, pipeline_folder, replace_pipelined), repeat = repeat), size = size))
+    return(results)
+
+# Time to start the scripts as new processes, as when they are run one package at a time from batch files.  The
+# previous scripts imported unpackpkg.py, and with it zstandard and lz4, at startup, as the "previous" runs do.
+def benchmark_startup (work_dir, repeat = 3):
+    import subprocess
+    results = []
+    def run_python (*args):
+        subprocess.run([sys.executable] + list(args), check = True, stdout = subprocess.DEVNULL)
+    for module in ['aa_inject_model', 'aa_replace_shaders', 'asset_xml_to_nx', 'verify_pkg']:
+        results.append(compare('import {0}'.format(module), lambda: run_python('-c', 'import unpackpkg, ' + module),\
+            lambda: run_python('-c', 'import ' + module), repeat = repeat))
+    loaded_modules = subprocess.run([sys.executable, '-c', 'import sys, aa_replace_shaders, asset_xml_to_nx, verify_pkg;'\
+        ' print(" ".join([x for x in ["unpackpkg", "zstandard", "lz4"] if x in sys.modules]))'],\
+        check = True, capture_output = True, text = True).stdout.strip()
+    print("Codec modules loaded by those imports: {0}".format(loaded_modules if loaded_modules != '' else 'none'))
+    results.append(measure('ed8_inject.py --help', run_python, 'ed8_inject.py', '--help', repeat = repeat))
+    for flags in [0, 8]:
+        try:
+            pkg_file = make_pkg_file(os.path.join(work_dir, 'startup{0}.pkg'.format(flags)), 100, 1024, flags = flags)
+        except ImportError as e:
+            print("ed8_inject.py verify (flags {0}): skipped, {1}".format(flags, e))
+            continue
+        results.append(measure('ed8_inject.py verify (flags {0})'.format(flags), run_python, 'ed8_inject.py', 'verify',\
+            '-j', '1', pkg_file, repeat = repeat))
+    return(results)
+
+# Prints the change in time of each benchmark against the results of an earlier run saved with --json
+def compare_with_previous_run (results, previous_results_filename):
+    with open(previous_results_filename, 'r', encoding='utf-8') as f:
+        previous_results = {get_result_key(x): x for x in json.load(f)["results"]}
+    print("\nChange against {0}:".format(previous_results_filename))
+    for result in results:
+        previous_result = previous_results.get(get_result_key(result))
+        if previous_result is not None and get_result_time(previous_result) > 0:
+            print("{0}: {1:+.1%}".format(get_result_key(result),\
+                get_result_time(result) / get_result_time(previous_result) - 1))
+
+def get_result_key (result):
+    return(' '.join([result["benchmark"]] + [str(result[x]) for x in ["sample", "method"] if x in result]))
+
+def get_result_time (result):
+    return(result["current"] if "current" in result else result["time"])
+
+if __name__ == "__main__":
+    # Set current directory
+    os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--entries', help="Number of entries in the synthetic archives (default 50000)", type=int, default=50000)
+    parser.add_argument('-s', '--size', help="Size in MB of the large entry for the streaming benchmark (default 64)", type=int, default=64)
+    parser.add_argument('-r', '--repeat', help="Number of timing runs, the best is reported (default 3)", type=int, default=3)
+    parser.add_argument('-f', '--files', help="Number of entries in the packages for the hot path benchmarks (default 1000)", type=int, default=1000)
+    parser.add_argument('--file-size', help="Size in bytes of those entries (default 16384)", type=int, default=16384)
+    parser.add_argument('-b', '--benchmarks', help="Benchmarks to run (default all)", nargs='+',\
+        choices=['toc', 'xml', 'compression', 'decompression', 'streaming', 'hot', 'pipeline', 'startup'],\
+        default=['toc', 'xml', 'compression', 'decompression', 'streaming', 'hot', 'pipeline', 'startup'])
+    parser.add_argument('--json', help="Save the results to this .json file")
+    parser.add_argument('--compare', help="Compare the times with the results of an earlier run saved with --json")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        if 'toc' in args.benchmarks:
+            results += benchmark_toc_parsing(work_dir, args.entries, args.repeat)
+        if 'xml' in args.benchmarks:
+            results += benchmark_xml_conversion(args.entries // 10, args.repeat)
+        if 'compression' in args.benchmarks:
+            results += benchmark_compression(args.entries // 10)
+        if 'decompression' in args.benchmarks:
+            results += benchmark_decompression(work_dir, args.files, args.file_size, args.repeat)
+        if 'streaming' in args.benchmarks:
+            results += benchmark_streaming_extraction(work_dir, args.size * 1048576)
+        if 'hot' in args.benchmarks:
+            results += benchmark_hot_paths(work_dir, args.files, args.file_size, args.repeat)
+        if 'pipeline' in args.benchmarks:
+            results += benchmark_pipeline(work_dir, args.files, args.file_size, args.repeat)
+        if 'startup' in args.benchmarks:
+            results += benchmark_startup(work_dir, args.repeat)
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"date": time.strftime('%Y-%m-%d %H:%M:%S'), "python": sys.version.split()[0],\
+                "platform": sys.platform, "arguments": vars(args), "results": results}, f, indent = 4)
+    if args.compare is not None:
+        compare_with_previous_run(results, args.compare)
@@ -0,0 +1,171 @@
+# Single command line entry point for the scripts, for use from the shell and in batch files.  Every subcommand
+# takes any number of packages, and only the scripts a subcommand needs are imported when it runs.  The codecs
+# (zstandard, lz4) are only loaded when the first compressed entry is read, so commands that only read TOCs or
+# uncompressed entries start quickly even when run many times.
+# Unlike the individual scripts, it works on the files in the current folder, not in the folder of the script.
+#
+# Requires the scripts of the subcommands and their requirements, put in the same directory
+# Usage: python3 ed8_inject.py {inject,replace-shaders,to-nx,decompress,txe-extract,verify} --help
+#
+# GitHub eArmada8/ed8_inject
+
+import sys, os, glob, argparse
+
+def strip_pkg_extension (pkg_name):
+    return(pkg_name[:-4] if pkg_name[-4:].lower() == '.pkg' else pkg_name)
+
+# The packages given, or every .pkg in the current folder, as names without .pkg
+def get_pkg_names (pkg_names):
+    if len(pkg_names) == 0:
+        return([x[:-4] for x in sorted(glob.glob('*.pkg'))])
+    missing_pkgs = [x for x in pkg_names if not os.path.exists(strip_pkg_extension(x) + '.pkg')]
+    if len(missing_pkgs) > 0:
+        raise Exception('Error: Packages {0} do not exist!'.format(missing_pkgs))
+    return([strip_pkg_extension(x) for x in pkg_names])
+
+def check_compression (compression):
+    from pkg_compression import parse_compression
+    try:
+        parse_compression(compression)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return(compression)
+
+def run_inject (args):
+    from aa_inject_model import inject_swap_manifest, read_swap_manifest, normalize_pkg_name
+    if len(args.packages) % 2 != 0:
+        raise Exception('Error: Packages must be given in pairs of source and target!')
+    swaps = read_swap_manifest(args.manifest) if args.manifest is not None else []
+    swaps += [[normalize_pkg_name(args.packages[i]), normalize_pkg_name(args.packages[i+1])]\
+        for i in range(0, len(args.packages), 2)]
+    return(1 if len(inject_swap_manifest(swaps, args.compress_xml, args.jobs)) > 0 else 0)
+
+def run_replace_shaders (args):
+    from aa_replace_shaders import PkaArchive, build_shader_index, replace_shaders_in_pkgs
+    if args.pka is None and args.folder is None and len(args.packages) == 0:
+        raise Exception('Error: Give the packages to patch when searching the current folder for shaders!')
+    pkg_names = get_pkg_names(args.packages)
+    if args.pka is not None:
+        pkgs_with_missing_shaders, untouched_pkgs = replace_shaders_in_pkgs(pkg_names, PkaArchive(args.pka),\
+            jobs = args.jobs, incremental = args.incremental, pipelined = args.pipeline)
+    elif args.folder is not None:
+        base_dir = os.getcwd()
+        os.chdir(args.folder)
+        try:
+            pkgs_with_missing_shaders, untouched_pkgs = replace_shaders_in_pkgs(pkg_names, False, build_shader_index(),\
+                prefix = os.path.relpath(base_dir) + os.sep, jobs = args.jobs, incremental = args.incremental,\
+                pipelined = args.pipeline)
+        finally:
+            os.chdir(base_dir)
+    else:
+        # Each package is patched from the others in turn, with the shader index built again every time
+        pkgs_with_missing_shaders, untouched_pkgs = replace_shaders_in_pkgs(pkg_names, incremental = args.incremental,\
+            pipelined = args.pipeline)
+    if args.incremental:
+        print("\n{0} .pkg file(s) already had matching shaders and were left untouched.".format(len(untouched_pkgs)))
+    if len(pkgs_with_missing_shaders) > 0:
+        print("\nWarning! Shader replacement was not successful in the following .pkg files: {}.".format(\
+            [os.path.basename(x) + '.pkg' for x in pkgs_with_missing_shaders]))
+    return(0)
+
+def run_to_nx (args):
+    from asset_xml_to_nx import process_pkgs
+    process_pkgs(get_pkg_names(args.packages), args.jobs, args.compress_xml, args.pipeline)
+    return(0)
+
+def run_decompress (args):
+    import importlib
+    decompresspkg = importlib.import_module('aa - decompresspkg')
+    pkg_files = []
+    for path in args.packages:
+        if os.path.isdir(path):
+            pkg_files.extend(sorted(glob.glob(os.path.join(path, '*.pkg'))))
+        elif any(x in path for x in '*?['):
+            pkg_files.extend(sorted(glob.glob(path)))
+        else:
+            pkg_files.append(path)
+    failures = decompresspkg.decompress_pkgs(pkg_files, args.output, jobs = args.jobs, force = args.force,\
+        compress_xml = args.compress_xml)
+    return(1 if len(failures) > 0 else 0)
+
+def run_txe_extract (args):
+    import txe_file_extract
+    for filename in args.files:
+        if filename[-4:] == '.bra':
+            if not txe_file_extract.extract_archive(filename, overwrite = args.overwrite, jobs = args.jobs):
+                raise Exception('Error: Archive "' + filename + '" does not exist!')
+        else:
+            txe_file_extract.extract_files(filename, overwrite = args.overwrite, exact_match = args.exact,\
+                specific_archive = args.archive if args.archive is not None else False, jobs = args.jobs)
+    return(0)
+
+def run_verify (args):
+    from verify_pkg import find_files_to_verify, verify_files
+    filenames = find_files_to_verify(args.files)
+    missing_files = [x for x in filenames if not os.path.isfile(x)]
+    if len(missing_files) > 0:
+        raise Exception('Error: {0} not found!'.format(missing_files))
+    return(1 if len(verify_files(filenames, args.jobs)) > 0 else 0)
+
+def make_parser ():
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument('--stats', help="Report the time and I/O of each stage at the end", action="store_true")
+    common.add_argument('--stats-json', help="Also save the stats to this .json file")
+    compress_xml = argparse.ArgumentParser(add_help = False)
+    compress_xml.add_argument('--compress-xml', help="Store the new XML compressed: none (default), same, lz4, nislzss or zstd, optionally with a level, e.g. lz4:12",\
+        default='none', type=check_compression)
+
+    parser = argparse.ArgumentParser(description="Runs the ed8_inject scripts on the files in the current folder.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparser = subparsers.add_parser('inject', parents=[common, compress_xml], help="Inject models (aa_inject_model.py)")
+    subparser.add_argument('packages', nargs='*', help="Pairs of source and target packages, e.g. C_CHR000 C_CHR001 C_CHR001 C_CHR000")
+    subparser.add_argument('-m', '--manifest', help="Also run the swaps of a .csv or .json manifest")
+    subparser.add_argument('-j', '--jobs', help="Number of sources to inject in parallel (default 1, 0 is one per CPU)", type=int, default=1)
+    subparser.set_defaults(function=run_inject)
+
+    subparser = subparsers.add_parser('replace-shaders', parents=[common], help="Replace shaders (aa_replace_shaders.py)")
+    subparser.add_argument('packages', nargs='*', help="Packages to patch (default: all the packages with --pka or --folder)")
+    source = subparser.add_mutually_exclusive_group()
+    source.add_argument('--pka', help="Take the shaders from this .pka (e.g. assets.pka)")
+    source.add_argument('--folder', help="Take the shaders from the packages in this folder (default: the other packages in the current folder, one package at a time)")
+    subparser.add_argument('-j', '--jobs', help="Number of packages to patch in parallel with --pka or --folder (default 1, 0 is one per CPU)", type=int, default=1)
+    subparser.add_argument('-i', '--incremental', help="Skip packages whose shaders already match", action="store_true")
+    subparser.add_argument('--pipeline', help="Plan the next package while one is written, in one process, instead of --jobs (not when the shaders come from the packages being patched)", action="store_true")
+    subparser.set_defaults(function=run_replace_shaders)
+
+    subparser = subparsers.add_parser('to-nx', parents=[common, compress_xml], help="Convert asset_D3D11.xml to asset_NX.xml (asset_xml_to_nx.py)")
+    subparser.add_argument('packages', nargs='*', help="Packages to convert (default: all)")
+    subparser.add_argument('-j', '--jobs', help="Number of packages to convert in parallel (default 1, 0 is one per CPU)", type=int, default=1)
+    subparser.add_argument('--pipeline', help="Read, convert and write in overlapping stages in one process, instead of --jobs", action="store_true")
+    subparser.set_defaults(function=run_to_nx)
+
+    subparser = subparsers.add_parser('decompress', parents=[common, compress_xml], help="Decompress packages (aa - decompresspkg.py)")
+    subparser.add_argument('packages', nargs='+', help="Packages, folders of packages or wildcards such as \"*.pkg\"")
+    subparser.add_argument('-o', '--output', help="Output folder (default decompressed_output)", default='decompressed_output')
+    subparser.add_argument('-j', '--jobs', help="Number of packages to decompress in parallel (default: one per CPU)", type=int, default=0)
+    subparser.add_argument('-f', '--force', help="Decompress even if the output is already up to date", action="store_true")
+    subparser.set_defaults(function=run_decompress)
+
+    subparser = subparsers.add_parser('txe-extract', parents=[common], help="Extract files from TXe .bra archives (txe_file_extract.py)")
+    subparser.add_argument('files', nargs='+', help="Names of files to extract, or .bra archives to extract entirely")
+    subparser.add_argument('-e', '--exact', help="Search for exact match only", action="store_true")
+    subparser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
+    subparser.add_argument('-a', '--archive', help="Search only in this archive (e.g. --archive System.bra)")
+    subparser.add_argument('-j', '--jobs', help="Number of files to extract in parallel (0 = one per CPU, default 1)", type=int, default=1)
+    subparser.set_defaults(function=run_txe_extract)
+
+    subparser = subparsers.add_parser('verify', parents=[common], help="Check packages and .pka archives (verify_pkg.py)")
+    subparser.add_argument('files', nargs='+', help=".pkg or .pka files, folders of them, or wildcards such as \"*.pkg\"")
+    subparser.add_argument('-j', '--jobs', help="Number of processes (default: one per CPU)", type=int, default=0)
+    subparser.set_defaults(function=run_verify)
+    return(parser)
+
+if __name__ == "__main__":
+    # The scripts are imported from the folder of this script, but the files are found from the current folder
+    sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+    args = make_parser().parse_args()
+    if args.stats or args.stats_json is not None:
+        from stage_stats import start_stats
+        start_stats(args.stats_json)
+    sys.exit(args.function(args))
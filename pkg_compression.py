@@ -0,0 +1,138 @@
+# Short library to compress .pkg entries, the counterpart of the decompressors in unpackpkg.py.  Used by the
+# scripts to store the asset XML compressed again after rewriting it, instead of uncompressed with flags 0.
+# Every compressed entry is decompressed again with unpackpkg.py and compared before it is used; if that fails
+# (or the codec is not installed, or compression does not make the entry smaller) the entry stays uncompressed.
+#
+# Requires my fork of unpackpkg.py and stage_stats.py, put in the same directory
+#
+# GitHub eArmada8/ed8_inject
+
+import io, sys
+import stage_stats
+
+# unpackpkg.py imports the codec modules (zstandard, lz4) as it is loaded, which takes longer than anything else
+# at startup, so it is only imported when the first compressed entry is read or checked.  The scripts use these
+# instead of importing it themselves, and an operation that never meets a compressed entry never loads a codec.
+def get_unpackpkg ():
+    if 'unpackpkg' not in sys.modules:
+        import unpackpkg
+    return(sys.modules['unpackpkg'])
+
+def uncompress_nislzss (src, decompressed_size, compressed_size):
+    return(get_unpackpkg().uncompress_nislzss(src, decompressed_size, compressed_size))
+
+def uncompress_lz4 (src, decompressed_size, compressed_size):
+    return(get_unpackpkg().uncompress_lz4(src, decompressed_size, compressed_size))
+
+def uncompress_zstd (src, decompressed_size, compressed_size):
+    return(get_unpackpkg().uncompress_zstd(src, decompressed_size, compressed_size))
+
+# Compression methods, with the entry flags that mark them.  'same' uses the method the entry had originally.
+compression_flags = {'none': 0, 'nislzss': 1, 'lz4': 4, 'zstd': 8}
+compression_methods = ['none', 'same', 'nislzss', 'lz4', 'zstd']
+
+# NISLZSS: a 12-byte header (uncompressed size, compressed size including the header, marker byte), then literal
+# bytes.  The marker byte starts a back-reference of [marker, distance, length], and [marker, marker] is a literal
+# marker byte.  Distances of the marker value and above are stored plus one, so the longest distance is 254.
+# The marker is the least used byte, to keep the escapes rare.  Matches are found with a table of the last
+# position of every 4-byte sequence, which is quick in Python and works well on text such as the asset XML.
+def compress_nislzss (data):
+    data = bytes(data)
+    byte_counts = [data.count(bytes([i])) for i in range(256)]
+    marker = byte_counts.index(min(byte_counts))
+    output = bytearray()
+    last_positions = {}
+    i = 0
+    while i < len(data):
+        match_length = 0
+        if i + 4 <= len(data):
+            match_position = last_positions.get(data[i:i+4])
+            last_positions[data[i:i+4]] = i
+            if match_position is not None and i - match_position <= 254:
+                max_length = min(255, len(data) - i)
+                match_length = 4
+                while match_length < max_length and data[match_position + match_length] == data[i + match_length]:
+                    match_length += 1
+        if match_length >= 4:
+            distance = i - match_position
+            output += bytes([marker, distance if distance < marker else distance + 1, match_length])
+            for j in range(i + 1, min(i + match_length, len(data) - 3)):
+                last_positions[data[j:j+4]] = j
+            i += match_length
+        else:
+            output += bytes([marker, marker]) if data[i] == marker else data[i:i+1]
+            i += 1
+    return(len(data).to_bytes(4, 'little') + (len(output) + 12).to_bytes(4, 'little')\
+        + marker.to_bytes(4, 'little') + output)
+
+def compress_lz4 (data, level = None):
+    import lz4.block
+    if level is None:
+        return(lz4.block.compress(bytes(data), store_size=False))
+    return(lz4.block.compress(bytes(data), mode='high_compression', compression=level, store_size=False))
+
+def compress_zstd (data, level = None):
+    import zstandard
+    return(zstandard.ZstdCompressor(level = 3 if level is None else level).compress(bytes(data)))
+
+# Decompresses a compressed entry with unpackpkg.py, to check it before it is written
+def verify_compressed_entry (data, compressed_data, flags):
+    with io.BytesIO(compressed_data) as f:
+        if flags & 1:
+            decompressed_data = uncompress_nislzss(f, len(data), len(compressed_data))
+        elif flags & 4:
+            decompressed_data = uncompress_lz4(f, len(data), len(compressed_data))
+        else:
+            decompressed_data = uncompress_zstd(f, len(data), len(compressed_data))
+    return(bytes(decompressed_data) == bytes(data))
+
+# Splits a compression setting such as 'lz4', 'lz4:12' or 'zstd:19' into [method, level]
+def parse_compression (compression):
+    method, _, level = str(compression).lower().partition(':')
+    if method not in compression_methods:
+        raise ValueError('Error: Unknown compression "{0}", use one of {1}!'.format(compression, compression_methods))
+    return([method, int(level) if level != '' else None])
+
+# Returns [entry data, flags] for data (an uncompressed entry) compressed with the given compression setting.
+# original_flags are the flags the entry had, for 'same', which also keeps its zstd flag (8 or 16).
+def compress_entry (data, compression = 'none', original_flags = 0):
+    method, level = parse_compression(compression)
+    zstd_flag = 8
+    if method == 'same':
+        method = {1: 'nislzss', 4: 'lz4', 8: 'zstd', 16: 'zstd'}.get(original_flags & 29, 'none')
+        zstd_flag = original_flags & 24 if original_flags & 24 else 8
+    if method == 'none' or len(data) == 0:
+        return([data, 0])
+    with stage_stats.stage('compress'):
+        compressed_data, flags = compress_with_method(data, method, level)
+    if flags & 24:
+        flags = zstd_flag
+    stage_stats.count('compress', entries = 1, bytes_read = len(data), bytes_written = len(compressed_data))
+    return([compressed_data, flags])
+
+def compress_with_method (data, method, level = None):
+    try:
+        if method == 'nislzss':
+            compressed_data = compress_nislzss(data)
+        elif method == 'lz4':
+            compressed_data = compress_lz4(data, level)
+        else:
+            compressed_data = compress_zstd(data, level)
+        if len(compressed_data) < len(data) and verify_compressed_entry(data, compressed_data, compression_flags[method]):
+            return([compressed_data, compression_flags[method]])
+    except ImportError:
+        pass # Codec or unpackpkg.py not installed, so the entry is left uncompressed
+    return([data, 0])
+
+# Removes --compress-xml METHOD (or --compress-xml=METHOD) from the command line, so the positional arguments
+# work as before.  Returns the compression setting, 'none' if not given.
+def pop_compression_argument (argv):
+    compression = 'none'
+    for i in range(len(argv)-1, 0, -1):
+        if argv[i][:15] == '--compress-xml=':
+            compression = argv.pop(i)[15:]
+        elif argv[i] == '--compress-xml' and i + 1 < len(argv):
+            compression = argv.pop(i+1)
+            argv.pop(i)
+    parse_compression(compression)
+    return(compression)
@@ -0,0 +1,135 @@
+# Short library to measure where the time goes in the scripts: the wall time, bytes read and written and entries
+# processed of each stage (TOC parsing, decompression, searching, writing...).  Used by the --stats option of the
+# scripts, or from Python with enable_stats() and report_stats().  Stats are off by default, and then stage()
+# returns a shared empty context and count() returns at once, so the instrumented code runs as before.  Code that
+# runs once per entry checks stage_stats.stage_totals is None first, and then skips the bookkeeping entirely.
+#
+# GitHub eArmada8/ed8_inject
+
+import sys, os, time, json, threading, contextlib, functools
+
+stage_totals = None # Stage name -> {"time", "calls", "entries", "bytes_read", "bytes_written"}, None when disabled
+stage_totals_lock = threading.Lock() # Extraction and other parallel work run stages from several threads
+stats_start_time = None
+null_stage = contextlib.nullcontext()
+stat_names = ["time", "calls", "entries", "bytes_read", "bytes_written"]
+
+def enable_stats ():
+    global stage_totals, stats_start_time
+    stage_totals = {}
+    stats_start_time = time.perf_counter()
+
+def disable_stats ():
+    global stage_totals
+    stage_totals = None
+
+def stats_enabled ():
+    return(stage_totals is not None)
+
+def add_to_stage (name, values):
+    with stage_totals_lock:
+        totals = stage_totals.setdefault(name, dict.fromkeys(stat_names, 0))
+        for key in values:
+            totals[key] += values[key]
+
+# Adds entries processed and bytes read / written to a stage
+def count (name, entries = 0, bytes_read = 0, bytes_written = 0):
+    if stage_totals is None:
+        return
+    add_to_stage(name, {"entries": entries, "bytes_read": bytes_read, "bytes_written": bytes_written})
+
+class StageTimer:
+    def __init__ (self, name):
+        self.name = name
+
+    def __enter__ (self):
+        self.start_time = time.perf_counter()
+        return(self)
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        if stage_totals is not None:
+            add_to_stage(self.name, {"time": time.perf_counter() - self.start_time, "calls": 1})
+        return(False)
+
+# Times a stage: with stage('write'): ...  Stages can be nested, and then the outer time includes the inner one.
+def stage (name):
+    if stage_totals is None:
+        return(null_stage)
+    return(StageTimer(name))
+
+# Returns the stats recorded so far and starts again from zero
+def take_stats ():
+    global stage_totals
+    with stage_totals_lock:
+        totals, stage_totals = stage_totals, {}
+    return(totals)
+
+def merge_stats (totals):
+    if stage_totals is None or totals is None:
+        return
+    for name in totals:
+        add_to_stage(name, totals[name])
+
+# Process pools do not share the stats of the workers, so their jobs are wrapped with pool_job(function), which
+# sends back the stats of each job with its result, and the results are unwrapped with pool_results(), which
+# adds those stats to this process.  Without stats, the jobs run as before.
+def run_pool_job (function, collect_stats, job):
+    if not collect_stats:
+        return([function(job), None])
+    enable_stats()
+    result = function(job)
+    return([result, take_stats()])
+
+def pool_job (function):
+    return(functools.partial(run_pool_job, function, stats_enabled()))
+
+def pool_results (results):
+    for result, totals in results:
+        merge_stats(totals)
+        yield result
+
+def format_stats (totals, elapsed_time):
+    lines = ["{0:<16}{1:>10}{2:>8}{3:>10}{4:>12}{5:>14}{6:>10}".format('Stage', 'Time (s)', 'Calls', 'Entries',\
+        'Read (MB)', 'Written (MB)', 'MB/s')]
+    for name in sorted(totals, key = lambda x: -totals[x]["time"]):
+        stats = totals[name]
+        size = max(stats["bytes_read"], stats["bytes_written"])
+        lines.append("{0:<16}{1:>10.3f}{2:>8}{3:>10}{4:>12.1f}{5:>14.1f}{6:>10}".format(name, stats["time"],\
+            stats["calls"], stats["entries"], stats["bytes_read"] / 1048576, stats["bytes_written"] / 1048576,\
+            "{0:.1f}".format(size / 1048576 / stats["time"]) if stats["time"] > 0 and size > 0 else '-'))
+    lines.append("Total wall time {0:.3f}s.  Stages can be nested, and in parallel runs their times are summed"\
+        " over all the workers, so they do not add up to the wall time.".format(elapsed_time))
+    return("\n".join(lines))
+
+# Prints the stats, and saves them to json_filename if given
+def report_stats (json_filename = None):
+    if stage_totals is None:
+        return
+    elapsed_time = time.perf_counter() - stats_start_time
+    print("\n" + format_stats(stage_totals, elapsed_time))
+    if json_filename is not None:
+        with open(json_filename, 'w', encoding='utf-8') as f:
+            json.dump({"wall_time": elapsed_time, "stages": stage_totals}, f, indent = 4)
+
+# Enables the stats, and reports them when the script exits
+def start_stats (json_filename = None):
+    import atexit
+    enable_stats()
+    atexit.register(report_stats, os.path.abspath(json_filename) if json_filename is not None else None)
+
+# Removes --stats and --stats-json FILE (or --stats-json=FILE) from the command line, so the positional arguments
+# work as before.  If either is present, stats are enabled and reported when the script exits.
+def pop_stats_arguments (argv):
+    enabled, json_filename = False, None
+    for i in range(len(argv)-1, 0, -1):
+        if argv[i] == '--stats':
+            argv.pop(i)
+            enabled = True
+        elif argv[i][:13] == '--stats-json=':
+            json_filename = argv.pop(i)[13:]
+        elif argv[i] == '--stats-json' and i + 1 < len(argv):
+            json_filename = argv.pop(i+1)
+            argv.pop(i)
+    if enabled or json_filename is not None:
+        start_stats(json_filename)
+    return(enabled or json_filename is not None)
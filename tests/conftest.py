@@ -0,0 +1,4 @@
+# The scripts are not a package, so the tests import them from the folder above, as the scripts import each other
+import os, sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,51 @@
+# Regression tests for the streaming "aa - decompresspkg.py": the packages it writes must be byte for byte those
+# of the previous in-memory implementation (legacy_decompress_pkg in benchmark.py), for every kind of compression.
+#
+# Requires pytest, and unpackpkg.py (with lz4 and zstandard) for the compressed packages
+
+import os, importlib
+import pytest
+import benchmark
+
+decompresspkg = importlib.import_module('aa - decompresspkg')
+
+# A synthetic package stored with flags, skipping the test if the codecs it needs are not installed
+def make_test_pkg (tmp_path, flags, number_of_files = 64, file_size = 4096):
+    if flags != 0:
+        pytest.importorskip('unpackpkg')
+    if flags & 4:
+        pytest.importorskip('lz4.block')
+    if flags & 24:
+        pytest.importorskip('zstandard')
+    return(benchmark.make_pkg_file(str(tmp_path / 'test.pkg'), number_of_files, file_size, flags = flags))
+
+# Returns the packages written by the previous and the current implementation
+def decompress_both (pkg_file):
+    benchmark.legacy_decompress_pkg(pkg_file, pkg_file + '.legacy')
+    decompresspkg.decompress_pkg(pkg_file, pkg_file + '.streaming')
+    with open(pkg_file + '.legacy', 'rb') as f1, open(pkg_file + '.streaming', 'rb') as f2:
+        return(f1.read(), f2.read())
+
+@pytest.mark.parametrize('flags', [0, 1, 4, 8, 16])
+def test_decompress_pkg_matches_legacy (tmp_path, flags):
+    legacy_output, streaming_output = decompress_both(make_test_pkg(tmp_path, flags))
+    assert streaming_output == legacy_output
+
+@pytest.mark.parametrize('flags', [0, 4])
+def test_decompress_pkg_matches_legacy_single_entry (tmp_path, flags):
+    legacy_output, streaming_output = decompress_both(make_test_pkg(tmp_path, flags, number_of_files = 1))
+    assert streaming_output == legacy_output
+
+@pytest.mark.parametrize('flags', [0, 8])
+def test_decompress_pkg_matches_legacy_large_entries (tmp_path, flags):
+    legacy_output, streaming_output = decompress_both(make_test_pkg(tmp_path, flags, number_of_files = 4,\
+        file_size = 4 * 1048576))
+    assert streaming_output == legacy_output
+
+def test_decompress_pkg_replaces_output (tmp_path):
+    pkg_file = make_test_pkg(tmp_path, 0)
+    with open(pkg_file + '.streaming', 'wb') as f:
+        f.write(b'previous output')
+    legacy_output, streaming_output = decompress_both(pkg_file)
+    assert streaming_output == legacy_output
+    assert not os.path.exists(pkg_file + '.streaming.tmp')
@@ -0,0 +1,71 @@
+# Equivalence tests for the streaming asset XML conversion: stream_convert_asset_xml must give exactly the bytes of
+# the previous ElementTree conversion (convert_asset_xml_tree), and convert_asset_xml must give them for any XML,
+# falling back to ElementTree where the streaming converter does not apply.
+#
+# Requires pytest
+
+import xml.etree.ElementTree as ET
+import pytest
+import benchmark
+from asset_xml_to_nx import convert_asset_xml, convert_asset_xml_tree, stream_convert_asset_xml
+
+asset_xml_cases = {
+    "synthetic": benchmark.make_asset_xml(500),
+    "doctype entities": b'<?xml version="1.0"?>\n<!DOCTYPE assets [<!ENTITY d3d "data/D3D11"><!ENTITY fx "p_fx">]>\n'\
+        b'<assets><asset symbol="A"><cluster path="&d3d;/chr/a.dae" type="&fx;">&d3d;</cluster></asset></assets>',
+    "external doctype": b'<?xml version="1.0"?>\n<!DOCTYPE assets SYSTEM "assets.dtd">\n'\
+        b'<assets><asset><cluster path="data/D3D11/a.dae" type="p_fx"/></asset></assets>',
+    "cdata": b'<assets><asset><cluster path="data/D3D11/a.dae" type="p_fx"><![CDATA[<x> & "q"]]> y</cluster>'\
+        b'</asset></assets>',
+    "latin-1": '<?xml version="1.0" encoding="iso-8859-1"?>\n<assets><asset symbol="\xe9">'\
+        '<cluster path="data/D3D11/\xe9.dae" type="p_fx" note="caf\xe9"/></asset></assets>'.encode('latin-1'),
+    "utf-16": '<?xml version="1.0" encoding="utf-16"?>\n<assets><asset>'\
+        '<cluster path="data/D3D11/\xe9中.dae" type="p_fx"/></asset></assets>'.encode('utf-16'),
+    "utf-8 bom": b'\xef\xbb\xbf<assets><asset><cluster path="data/D3D11/a.dae" type="p_fx"/></asset></assets>',
+    "comments and pis": b'<?xml version="1.0"?>\n<!-- top -->\n<?pi top?>\n<assets><!-- c --><?target data?>'\
+        b'<asset><!-- c2 --><cluster path="data/D3D11/a.dae" type="p_fx"/>tail<?p x?></asset></assets>\n<!-- end -->',
+    "attribute whitespace": b'<assets><asset><cluster path="data/D3D11/a\tb\nc.dae" type="p_fx" '\
+        b'note="&quot;&apos;&#13;&#9;&#10;&amp;&lt;&gt;"/></asset></assets>',
+    "nested elements": b'<assets><asset><cluster path="data/D3D11/a.dae" type="p_fx">'\
+        b'<sub path="data/D3D11/b.dae" type="p_fx"/></cluster></asset><asset path="data/D3D11/top"/></assets>',
+}
+
+namespace_cases = {
+    "prefixed namespace": b'<assets xmlns:x="urn:x"><asset><x:cluster path="data/D3D11/a.dae" type="p_fx"/>'\
+        b'</asset></assets>',
+    "default namespace": b'<assets xmlns="urn:x"><asset><cluster path="data/D3D11/a.dae" type="p_fx"/></asset></assets>',
+}
+
+@pytest.mark.parametrize('name', asset_xml_cases)
+def test_stream_convert_matches_tree (name):
+    assert stream_convert_asset_xml(asset_xml_cases[name]) == convert_asset_xml_tree(asset_xml_cases[name])
+
+@pytest.mark.parametrize('name', list(asset_xml_cases) + list(namespace_cases))
+def test_convert_asset_xml_matches_tree (name):
+    xml_binary = dict(asset_xml_cases, **namespace_cases)[name]
+    assert convert_asset_xml(xml_binary) == convert_asset_xml_tree(xml_binary)
+
+@pytest.mark.parametrize('name', namespace_cases)
+def test_stream_convert_rejects_namespaces (name):
+    with pytest.raises(ValueError):
+        stream_convert_asset_xml(namespace_cases[name])
+
+def test_converted_attributes ():
+    converted_xml = convert_asset_xml(asset_xml_cases["synthetic"])
+    assert b'data/D3D11' not in converted_xml
+    assert b'type="p_fx"' not in converted_xml
+    assert b'data/NX' in converted_xml
+
+@pytest.mark.parametrize('xml_binary', [b'', b'<assets><asset></assets>', b'<assets>&undefined;</assets>'])
+def test_invalid_xml_raises_parse_error (xml_binary):
+    with pytest.raises(ET.ParseError):
+        convert_asset_xml(xml_binary)
+
+# Multi-byte encodings other than UTF-8 and UTF-16 are not supported by ElementTree either
+def test_unsupported_encoding_raises_as_before ():
+    xml_binary = '<?xml version="1.0" encoding="shift_jis"?>\n<assets><asset symbol="キ">'\
+        '<cluster path="data/D3D11/a.dae" type="p_fx"/></asset></assets>'.encode('shift_jis')
+    with pytest.raises(ValueError):
+        convert_asset_xml_tree(xml_binary)
+    with pytest.raises(ValueError):
+        convert_asset_xml(xml_binary)
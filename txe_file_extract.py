@@ -1,49 +1,181 @@
 # Short script / library to extract files from BRA archives in Tokyo Xanadu eX+.  It can be used in interactive
 # mode, with command line arguments, or as a library.  Thanks to Sewer56, Luigi Auriemma (QuickBMS), Ekey@Xentax!
+# Requires archive_handles.py and stage_stats.py, put in the same directory
 # Instructions: /path/to/python3 txe_file_extract.py --help
 # GitHub eArmada8/misc_kiseki
 
 import os, struct, sys, glob, zlib
+from archive_handles import * # Shared pool of memory-mapped archives
+from stage_stats import * # Optional --stats instrumentation
+
+# The index is a sidecar file next to the .bra archives, holding the parsed file list of each archive.  Each
+# archive's entry is keyed by its size and mtime, and only re-parsed when either one changes.
+# The sidecar is a header (magic, version, number of archives), then for each archive its name length, size, mtime
+# and number of files, its name, and one record per file (the directory entry fields and the name length) followed
+# by the file's full name.  It is read with struct only, so a foreign index cannot run code.
+index_filename = 'txe_file_index.bin'
+index_version = 2
+index_header_struct = struct.Struct('<4sII')
+index_archive_struct = struct.Struct('<HQqI')
+index_entry_struct = struct.Struct('<QIIIIHHIH')
+file_index = None # In-memory copy, so repeated lookups in the same run do not reload the sidecar
 
 def get_archivelist():
     return glob.glob('*.bra')
 
+# Each directory entry is a fixed 24-byte record followed by a variable-length name
+file_entry_struct = struct.Struct('<IIIIHHI')
+
+def read_archive_directory(archivefile):
+    with open(archivefile, 'rb') as f:
+        fileHeader = f.read(4)
+        if fileHeader != b'PDA\x00':
+            return(False)
+        compressionType, fileEntryOffset, fileCount = struct.unpack('<3I', f.read(12))
+        f.seek(fileEntryOffset)
+        # The whole directory region is read at once, and the entries are decoded from the buffer
+        return(fileEntryOffset, fileCount, f.read())
+
+def parse_filelist(archivefile, fileEntryOffset, fileCount, directoryData):
+    view = memoryview(directoryData)
+    pos = 0
+    for i in range(fileCount):
+        fileNameOffset = fileEntryOffset + pos
+        fields = file_entry_struct.unpack_from(view, pos)
+        pos += file_entry_struct.size
+        # decode / encode is to sanitize name by removing all non-ASCII characters
+        fileNameEntry = bytes(view[pos:pos+fields[4]]).decode('ascii','ignore').encode()
+        pos += fields[4]
+        if (fileNameEntry.find(b'\x00') >= 0):
+            fileNameEntry = fileNameEntry[:fileNameEntry.find(b'\x00')]
+        yield(make_file_entry(archivefile, fileNameOffset, fields, fileNameEntry))
+
+# fields are the values of file_entry_struct, and fileNameEntry the sanitized full name
+def make_file_entry(archivefile, fileNameOffset, fields, fileNameEntry):
+    fileEntry = {}
+    fileEntry["fileNameOffset"] = fileNameOffset
+    fileEntry["filePackedTime"], fileEntry["unknown"], fileEntry["compressedSize"],\
+        fileEntry["uncompressedSize"], fileEntry["fileNameLength"], fileEntry["fileFlags"],\
+        fileEntry["fileOffset"] = fields
+    fileEntry["fileNameEntry"] = fileNameEntry
+    fileEntry["fileName"] = fileEntry["fileNameEntry"][fileEntry["fileNameEntry"].rfind(b'\\')+1:]
+    if (fileEntry["fileNameEntry"].rfind(b'\\') >= 0):
+        fileEntry["dirName"] = fileEntry["fileNameEntry"][:fileEntry["fileNameEntry"].rfind(b'\\')]
+    else:
+        fileEntry["dirName"] = ''
+    fileEntry["archiveName"] = archivefile
+    return(fileEntry)
+
+# Lazy version of get_filelist, yields nothing if the archive does not exist or is not a BRA archive
+def iter_filelist(archivefile):
+    if os.path.exists(archivefile):
+        directory = read_archive_directory(archivefile)
+        if directory != False:
+            yield from parse_filelist(archivefile, *directory)
+
 def get_filelist(archivefile):
     if os.path.exists(archivefile):
-        with open(archivefile, 'rb') as f:
-            fileHeader = f.read(4)
-            if fileHeader != b'PDA\x00':
+        with stage('toc'):
+            directory = read_archive_directory(archivefile)
+            if directory == False:
                 return(False)
-            compressionType, = struct.unpack('<I', f.read(4))
-            fileEntryOffset, = struct.unpack('<I', f.read(4))
-            fileCount, = struct.unpack('<I', f.read(4))
-            fileList = []
-            f.seek(fileEntryOffset)
-            for i in range(fileCount):
-                fileEntry = {}
-                fileEntry["fileNameOffset"] = f.tell()
-                fileEntry["filePackedTime"], = struct.unpack('<I', f.read(4))
-                fileEntry["unknown"], = struct.unpack('<I', f.read(4))
-                fileEntry["compressedSize"], = struct.unpack('<I', f.read(4))
-                fileEntry["uncompressedSize"], = struct.unpack('<I', f.read(4))
-                fileEntry["fileNameLength"], = struct.unpack('<H', f.read(2))
-                fileEntry["fileFlags"], = struct.unpack('<H', f.read(2))
-                fileEntry["fileOffset"], = struct.unpack('<I', f.read(4))
-                # decode / encode is to sanitize name by removing all non-ASCII characters
-                fileEntry["fileNameEntry"] = f.read(fileEntry["fileNameLength"]).decode('ascii','ignore').encode()
-                if (fileEntry["fileNameEntry"].find(b'\x00') >= 0):
-                    fileEntry["fileNameEntry"] = fileEntry["fileNameEntry"][:fileEntry["fileNameEntry"].find(b'\x00')]
-                fileEntry["fileName"] = fileEntry["fileNameEntry"][fileEntry["fileNameEntry"].rfind(b'\\')+1:]
-                if (fileEntry["fileNameEntry"].rfind(b'\\') >= 0):
-                    fileEntry["dirName"] = fileEntry["fileNameEntry"][:fileEntry["fileNameEntry"].rfind(b'\\')]
-                else:
-                    fileEntry["dirName"] = ''
-                fileEntry["archiveName"] = archivefile
-                fileList.append(fileEntry)
+            fileList = list(parse_filelist(archivefile, *directory))
+        count('toc', entries = len(fileList), bytes_read = len(directory[2]))
         return(fileList)
     else:
         return(False)
 
+def get_archive_key(archivefile):
+    archive_stat = os.stat(archivefile)
+    return([archive_stat.st_size, archive_stat.st_mtime_ns])
+
+def load_file_index():
+    try:
+        with open(index_filename, 'rb') as f:
+            data = f.read()
+        return(read_file_index(data))
+    except (OSError, ValueError, IndexError, struct.error):
+        pass # Missing, truncated or foreign index, every archive is parsed again
+    return({"version": index_version, "archives": {}})
+
+def read_file_index(data):
+    magic, version, archiveCount = index_header_struct.unpack_from(data, 0)
+    if magic != b'TXEI' or version != index_version:
+        raise ValueError("Not a current TXe file index")
+    index = {"version": index_version, "archives": {}}
+    pos = index_header_struct.size
+    for i in range(archiveCount):
+        archiveNameLength, archiveSize, archiveMtime, fileCount = index_archive_struct.unpack_from(data, pos)
+        pos += index_archive_struct.size
+        archive = os.fsdecode(data[pos:pos+archiveNameLength])
+        pos += archiveNameLength
+        fileList = []
+        for j in range(fileCount):
+            fields = index_entry_struct.unpack_from(data, pos)
+            pos += index_entry_struct.size
+            fileNameEntry = data[pos:pos+fields[8]]
+            pos += fields[8]
+            fileList.append(make_file_entry(archive, fields[0], fields[1:8], fileNameEntry))
+        index["archives"][archive] = {"key": [archiveSize, archiveMtime], "files": fileList,\
+            "names": build_name_lookup(fileList)}
+    if pos != len(data):
+        raise ValueError("Truncated or corrupt TXe file index")
+    return(index)
+
+def save_file_index(index):
+    data = [index_header_struct.pack(b'TXEI', index_version, len(index["archives"]))]
+    for archive in index["archives"]:
+        archive_entry = index["archives"][archive]
+        data.append(index_archive_struct.pack(len(os.fsencode(archive)), archive_entry["key"][0],\
+            archive_entry["key"][1], len(archive_entry["files"])) + os.fsencode(archive))
+        for fileEntry in archive_entry["files"]:
+            data.append(index_entry_struct.pack(fileEntry["fileNameOffset"], fileEntry["filePackedTime"],\
+                fileEntry["unknown"], fileEntry["compressedSize"], fileEntry["uncompressedSize"],\
+                fileEntry["fileNameLength"], fileEntry["fileFlags"], fileEntry["fileOffset"],\
+                len(fileEntry["fileNameEntry"])) + fileEntry["fileNameEntry"])
+    try:
+        with open(index_filename + '.tmp', 'wb') as f:
+            f.write(b''.join(data))
+        os.replace(index_filename + '.tmp', index_filename)
+    except OSError:
+        pass # Read-only folder, the index will just be rebuilt in memory next time
+
+# Brings the index up to date with the archives in the current folder, re-parsing only those that changed
+def update_file_index(archives = None):
+    global file_index
+    if archives is None:
+        archives = get_archivelist()
+    if file_index is None:
+        file_index = load_file_index()
+    changed = False
+    for archive in archives:
+        archive_key = get_archive_key(archive)
+        if archive not in file_index["archives"] or file_index["archives"][archive]["key"] != archive_key:
+            fileList = get_filelist(archive)
+            if fileList == False:
+                fileList = []
+            file_index["archives"][archive] = {"key": archive_key, "files": fileList,\
+                "names": build_name_lookup(fileList)}
+            changed = True
+    for archive in [x for x in file_index["archives"] if not os.path.exists(x)]:
+        del file_index["archives"][archive]
+        changed = True
+    if changed == True:
+        save_file_index(file_index)
+    return(file_index)
+
+# Maps the lowercase file name to the positions of all entries with that name
+def build_name_lookup(fileList):
+    names = {}
+    for i in range(len(fileList)):
+        names.setdefault(fileList[i]["fileName"].lower(), []).append(i)
+    return(names)
+
+def get_indexed_filelist(archivefile):
+    if not os.path.exists(archivefile):
+        return(False)
+    return(update_file_index([archivefile])["archives"][archivefile]["files"])
+
 def filter_filelist(fileList, fileName, exact_match = True):
     if exact_match == True:
         return list(filter(lambda file: fileName.lower().encode() == file["fileName"].lower(), fileList))
@@ -54,50 +186,127 @@ def find_file(fileName, exact_match = True, specific_archive = False):
     archives = get_archivelist()
     if (specific_archive != False):
         archives = list(filter(lambda archive: specific_archive.lower() in archive.lower(), archives))
+    index = update_file_index(archives)
+    with stage('search'):
+        files = search_file_index(index, archives, fileName, exact_match)
+    count('search', entries = len(files))
+    return(files)
+
+def search_file_index(index, archives, fileName, exact_match = True):
     files = []
     for i in range(len(archives)):
-        files.extend(filter_filelist(get_filelist(archives[i]), fileName, exact_match))
+        archive_entry = index["archives"][archives[i]]
+        if exact_match == True:
+            files.extend([archive_entry["files"][j] for j in archive_entry["names"].get(fileName.lower().encode(), [])])
+        else:
+            files.extend(filter_filelist(archive_entry["files"], fileName, exact_match))
     return(files)
 
 def extract_filedata(fileEntry):
-    with open(fileEntry["archiveName"], 'rb') as f:
-        f.seek(fileEntry['fileOffset'] + 16)
+    with stage('extract'):
         if fileEntry['uncompressedSize'] <= fileEntry['compressedSize']:
-            return(f.read(fileEntry['uncompressedSize'] - 16))
+            data = bytes(read_span(fileEntry["archiveName"], fileEntry['fileOffset'] + 16, fileEntry['uncompressedSize'] - 16))
         else:
-            return(zlib.decompress(f.read(fileEntry['compressedSize'] - 16), wbits=-15))
+            data = zlib.decompress(read_span(fileEntry["archiveName"], fileEntry['fileOffset'] + 16,\
+                fileEntry['compressedSize'] - 16), wbits=-15)
+    count('extract', entries = 1, bytes_read = fileEntry['compressedSize'] - 16, bytes_written = len(data))
+    return(data)
+
+# Streaming version of extract_filedata, which writes the file to sink (anything with a write method) in chunks
+# instead of returning it.  At most chunk_size bytes of decompressed data are held at a time, and the compressed
+# data is sliced from the archive mapping without copying.
+def extract_filedata_to(fileEntry, sink, chunk_size = 1048576):
+    with stage('extract'):
+        result = stream_filedata_to(fileEntry, sink, chunk_size)
+    count('extract', entries = 1, bytes_read = min(fileEntry['compressedSize'], fileEntry['uncompressedSize']) - 16,\
+        bytes_written = result)
+    return(result)
+
+def stream_filedata_to(fileEntry, sink, chunk_size = 1048576):
+    result = 0
+    if fileEntry['uncompressedSize'] <= fileEntry['compressedSize']:
+        data = read_span(fileEntry["archiveName"], fileEntry['fileOffset'] + 16, fileEntry['uncompressedSize'] - 16)
+        for pos in range(0, len(data), chunk_size):
+            result += sink.write(data[pos:pos+chunk_size])
+    else:
+        decompressor = zlib.decompressobj(wbits=-15)
+        compressed_data = read_span(fileEntry["archiveName"], fileEntry['fileOffset'] + 16, fileEntry['compressedSize'] - 16)
+        for pos in range(0, len(compressed_data), chunk_size):
+            data = compressed_data[pos:pos+chunk_size]
+            # Highly compressible data is drained in bounded pieces through unconsumed_tail
+            while data and not decompressor.eof:
+                result += sink.write(decompressor.decompress(data, chunk_size))
+                data = decompressor.unconsumed_tail
+            if decompressor.eof:
+                break
+        result += sink.write(decompressor.flush())
+    return(result)
 
-def extract_single_file(fileEntry, overwrite = False, interactive = False):
-    filedata = extract_filedata(fileEntry)
-    basedir = os.path.abspath(os.getcwd())
+def get_output_dir(fileEntry):
+    if fileEntry['dirName'] == '':
+        return('')
+    return(os.path.join(*fileEntry['dirName'].decode().split('\\')))
+
+# dir_cache is a set of folders already known to exist, so each folder is only created once per extraction
+def make_output_dir(fileEntry, dir_cache = None):
+    output_dir = get_output_dir(fileEntry)
+    if not output_dir == '' and (dir_cache is None or output_dir not in dir_cache):
+        os.makedirs(output_dir, exist_ok = True)
+        if dir_cache is not None:
+            dir_cache.add(output_dir)
+    return(output_dir)
+
+def extract_single_file(fileEntry, overwrite = False, interactive = False, dir_cache = None):
+    output_filename = os.path.join(make_output_dir(fileEntry, dir_cache), fileEntry['fileName'].decode())
     result = 0
-    if not fileEntry['dirName'] == '':
-        filedir = fileEntry['dirName'].decode().split('\\')
-        for j in range(len(filedir)):
-            if not os.path.exists(filedir[j]): 
-                os.mkdir(filedir[j])
-            os.chdir(filedir[j])
-    if os.path.exists(fileEntry['fileName'].decode()) and (interactive == True):
+    if os.path.exists(output_filename) and (interactive == True):
         if str(input(fileEntry['fileNameEntry'].decode() + " exists! Overwrite with version from " \
             + fileEntry['archiveName'] + "? (y/N) ")).lower()[0:1] == 'y':
             overwrite = True
-    if (overwrite == True) or not os.path.exists(fileEntry['fileName'].decode()):
-        with open(fileEntry['fileName'].decode(),'wb') as f_out:
-            result = f_out.write(filedata)
-        os.utime(fileEntry['fileName'].decode(), (fileEntry['filePackedTime'], fileEntry['filePackedTime']))
-    os.chdir(basedir)
+    if (overwrite == True) or not os.path.exists(output_filename):
+        with open(output_filename,'wb') as f_out:
+            result = extract_filedata_to(fileEntry, f_out)
+        os.utime(output_filename, (fileEntry['filePackedTime'], fileEntry['filePackedTime']))
     return(result)
 
-def extract_files(fileName, overwrite = False, exact_match = True, interactive = False, specific_archive = False):
-    fileEntries = find_file(fileName, exact_match, specific_archive)
+# Extracts the entries with a pool of worker threads (zlib and file I/O release the GIL).  Entries that
+# share an output path are reduced first to the one the serial loop would have left on disk: the first one
+# if not overwriting, the last one if overwriting.  Paths are compared as the file system would (e.g. ignoring
+# case on Windows), so two threads never write the same file.
+def extract_entries_parallel(fileEntries, overwrite = False, jobs = 0):
+    import concurrent.futures
+    output_entries = {}
+    for fileEntry in fileEntries:
+        output_filename = os.path.normcase(os.path.normpath(os.path.join(get_output_dir(fileEntry),\
+            fileEntry['fileName'].decode())))
+        if overwrite == True or output_filename not in output_entries:
+            output_entries[output_filename] = fileEntry
+    dir_cache = set()
+    for fileEntry in output_entries.values():
+        make_output_dir(fileEntry, dir_cache)
+    with concurrent.futures.ThreadPoolExecutor(max_workers = jobs if jobs > 0 else None) as executor:
+        results = list(executor.map(lambda fileEntry: extract_single_file(fileEntry, overwrite, False, dir_cache),\
+            output_entries.values()))
+    return(sum(results))
+
+def extract_entries(fileEntries, overwrite = False, interactive = False, jobs = 1):
+    if jobs != 1 and interactive == False:
+        return(extract_entries_parallel(fileEntries, overwrite, jobs))
+    dir_cache = set()
+    result = 0
     for i in range(len(fileEntries)):
-        extract_single_file(fileEntries[i], overwrite, interactive)
+        result += extract_single_file(fileEntries[i], overwrite, interactive, dir_cache)
+    return(result)
+
+def extract_files(fileName, overwrite = False, exact_match = True, interactive = False, specific_archive = False, jobs = 1):
+    fileEntries = find_file(fileName, exact_match, specific_archive)
+    extract_entries(fileEntries, overwrite, interactive, jobs)
 
-def extract_archive(archivename, overwrite = False, interactive = False):
+# jobs is the number of worker threads, 1 extracts serially and 0 uses one per CPU
+def extract_archive(archivename, overwrite = False, interactive = False, jobs = 1):
     if os.path.exists(archivename):
-        fileEntries = get_filelist(archivename)
-        for i in range(len(fileEntries)):
-            extract_single_file(fileEntries[i], overwrite, interactive)
+        fileEntries = get_indexed_filelist(archivename)
+        extract_entries(fileEntries, overwrite, interactive, jobs)
         return(True)
     else:
         return(False)
@@ -111,15 +320,21 @@ if __name__ == "__main__":
         parser = argparse.ArgumentParser()
         parser.add_argument('-e', '--exact', help="Search for exact match only", action="store_true")
         parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
+        parser.add_argument('-j', '--jobs', help="Number of files to extract in parallel (0 = one per CPU, default 1)", type=int, default=1)
         parser.add_argument('-a', '--archive', help="Search only in this archive (e.g. --archive System.bra)", nargs=1, default=False)
+        parser.add_argument('--stats', help="Report the time and I/O of each stage at the end", action="store_true")
+        parser.add_argument('--stats-json', help="Also save the stats to this .json file")
         parser.add_argument('filename', help="Name of file(s) to extract.  " \
             + "If a .bra file then will extract entire archive, otherwise will search all .bra files for this file.")
         args = parser.parse_args()
+        if args.stats or args.stats_json is not None:
+            start_stats(args.stats_json)
         if args.filename[-4:] == '.bra':
-            extract_archive(args.filename, overwrite = args.overwrite, interactive = False)
+            extract_archive(args.filename, overwrite = args.overwrite, interactive = False, jobs = args.jobs)
         else:
             extract_files(args.filename, overwrite = args.overwrite, exact_match = args.exact, \
-                interactive = False, specific_archive = args.archive[0] if isinstance(args.archive,list) else False)
+                interactive = False, specific_archive = args.archive[0] if isinstance(args.archive,list) else False,\
+                jobs = args.jobs)
     else:
         fileName = str(input("Please enter the name of files to extract: [partial matches allowed]  "))
         if fileName[-4:] == '.bra':
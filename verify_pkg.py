@@ -0,0 +1,180 @@
+# Short script to check the integrity of .pkg files and of the entries of .pka archives, without writing anything.
+# Checks that the TOC fits the file and every entry lies inside it, decompresses every entry to confirm its
+# uncompressed size, and checks the CRC32 of entries that have one (flag 2).  Folders and wildcards are accepted,
+# and the files (or the entries of a .pka) are checked in parallel.
+#
+# Requires aa_replace_shaders.py, aa_inject_model.py, archive_handles.py, pkg_compression.py, stage_stats.py and
+# unpackpkg.py, put in the same directory
+# Usage: python3 verify_pkg.py <files, folders or wildcards> [--jobs N]
+#
+# GitHub eArmada8/ed8_inject
+
+import sys, os, struct, glob, time, zlib
+from aa_replace_shaders import *
+
+known_flags = 31 # 1 NISLZSS, 2 CRC32, 4 lz4, 8 / 16 zstd
+pka_entries_per_job = 4096
+
+# Checks one entry (a dict as from get_pkg_contents) of the memory-mapped archive f.  With flag 2, the entry
+# starts with the CRC32 of the uncompressed data (little-endian), included in the compressed size.
+# Returns the list of problems found, empty if the entry is fine.
+def verify_entry (f, file_entry):
+    offset, compressed_size = file_entry["file_entry_offset"], file_entry["file_entry_compressed_size"]
+    if file_entry["file_entry_flags"] & ~known_flags:
+        return(['unknown flags {0}'.format(file_entry["file_entry_flags"])])
+    if offset + compressed_size > len(f):
+        return(['entry ends at {0}, past the end of the file at {1}'.format(offset + compressed_size, len(f))])
+    crc = None
+    if file_entry["file_entry_flags"] & 2:
+        if compressed_size < 4:
+            return(['entry too short for its CRC32'])
+        crc, = struct.unpack("<I", f[offset:offset+4])
+        file_entry = dict(file_entry, file_entry_offset = offset + 4, file_entry_compressed_size = compressed_size - 4)
+    try:
+        data = read_entry_data(f, file_entry, decompress = True)
+    except Exception as e:
+        return(['decompression failed ({0}: {1})'.format(type(e).__name__, e)])
+    problems = []
+    if len(data) != file_entry["file_entry_uncompressed_size"]:
+        problems.append('uncompressed size is {0}, TOC says {1}'.format(len(data), file_entry["file_entry_uncompressed_size"]))
+    if crc is not None and zlib.crc32(data) != crc:
+        problems.append('CRC32 is {0:08x}, entry says {1:08x}'.format(zlib.crc32(data), crc))
+    return(problems)
+
+# Checks a whole .pkg.  Returns [file, entries checked, bytes checked, [[file, entry name, problem], ...]]
+def verify_pkg (pkg_filename):
+    bad_entries = []
+    if os.path.getsize(pkg_filename) < 8:
+        return([pkg_filename, 0, 0, [[pkg_filename, '', 'file too short for a .pkg header']]])
+    f = open_archive(pkg_filename)
+    try:
+        total_file_entries, = struct.unpack("<I", f[4:8])
+        toc_end = 8 + 80 * total_file_entries
+        if toc_end > len(f):
+            return([pkg_filename, 0, len(f), [[pkg_filename, '', 'TOC of {0} entries ends at {1}, past the end of the file at {2}'.format(\
+                total_file_entries, toc_end, len(f))]]])
+        file_contents = get_pkg_contents(f)
+        with stage('verify'):
+            for file_entry in file_contents:
+                if file_entry["file_entry_offset"] < toc_end:
+                    problems = ['entry starts at {0}, inside the TOC'.format(file_entry["file_entry_offset"])]
+                else:
+                    problems = verify_entry(f, file_entry)
+                for problem in problems:
+                    bad_entries.append([pkg_filename, file_entry["file_entry_name"], problem])
+        count('verify', entries = len(file_contents), bytes_read = len(f))
+        return([pkg_filename, len(file_contents), len(f), bad_entries])
+    finally:
+        release_archive(pkg_filename)
+
+# Checks a range of the entries of a .pka.  file_entries are [hash, offset, compressed size, uncompressed size,
+# flags, name] as listed by get_pka_verify_jobs.  Returns the same as verify_pkg.
+def verify_pka_entries (pka_filename, file_entries):
+    bad_entries = []
+    f = open_archive(pka_filename)
+    with stage('verify'):
+        for file_entry_hash, offset, compressed_size, uncompressed_size, flags, file_entry_name in file_entries:
+            file_entry = make_pka_file_entry(file_entry_name, [offset, compressed_size, uncompressed_size, flags], '')
+            for problem in verify_entry(f, file_entry):
+                bad_entries.append([pka_filename, file_entry_name, problem])
+    bytes_checked = sum([x[2] for x in file_entries])
+    count('verify', entries = len(file_entries), bytes_read = bytes_checked)
+    return([pka_filename, len(file_entries), bytes_checked, bad_entries])
+
+# Splits the entries of a .pka into jobs.  Each stored file is checked once, under the first name that uses it.
+# Names that point to a hash missing from the file table are returned as bad entries.
+def get_pka_verify_jobs (pka_filename):
+    package_entries, file_entries = get_pka_toc(open_archive(pka_filename))
+    names, bad_entries = {}, []
+    for package_name in package_entries:
+        for file_entry_name, file_entry_hash in package_entries[package_name]:
+            if file_entry_hash not in file_entries:
+                bad_entries.append([pka_filename, package_name + '/' + file_entry_name.decode('utf-8', 'replace'),\
+                    'hash not found in the file table'])
+            else:
+                names.setdefault(file_entry_hash, file_entry_name.decode('utf-8', 'replace'))
+    entries = [[x] + file_entries[x] + [names.get(x, x.hex())] for x in file_entries]
+    entries.sort(key = lambda x: x[1]) # In file order, so each job reads one region of the archive
+    return([[pka_filename, entries[i:i+pka_entries_per_job]] for i in range(0, len(entries), pka_entries_per_job)],\
+        bad_entries)
+
+def format_bad_entry (bad_entry):
+    filename, file_entry_name, problem = bad_entry
+    return("Bad: {0}: {1}".format(filename if file_entry_name == '' else filename + ' ' + file_entry_name, problem))
+
+def verify_job (job):
+    try:
+        if isinstance(job, list):
+            return(verify_pka_entries(*job))
+        return(verify_pkg(job))
+    except Exception as e:
+        filename = job[0] if isinstance(job, list) else job
+        return([filename, 0, 0, [[filename, '', '{0}: {1}'.format(type(e).__name__, e)]]])
+
+# Checks .pkg and .pka files in parallel (jobs 0 is one process per CPU).  Returns the list of bad entries.
+def verify_files (filenames, jobs = 0):
+    import concurrent.futures
+    start_time = time.perf_counter()
+    verify_jobs, bad_entries = [], []
+    for filename in filenames:
+        if filename[-4:].lower() == '.pka':
+            try:
+                pka_jobs, pka_bad_entries = get_pka_verify_jobs(filename)
+            except Exception as e:
+                pka_jobs, pka_bad_entries = [], [[filename, '', 'unreadable TOC ({0}: {1})'.format(type(e).__name__, e)]]
+            for bad_entry in pka_bad_entries:
+                print(format_bad_entry(bad_entry))
+            verify_jobs.extend(pka_jobs)
+            bad_entries.extend(pka_bad_entries)
+        else:
+            verify_jobs.append(filename)
+    entries_checked, bytes_checked = 0, 0
+    if jobs == 1:
+        results = (verify_job(x) for x in verify_jobs)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs if jobs > 0 else None)
+        results = pool_results(executor.map(pool_job(verify_job), verify_jobs, chunksize = 4))
+    try:
+        for filename, file_entries_checked, file_bytes_checked, file_bad_entries in results:
+            entries_checked += file_entries_checked
+            bytes_checked += file_bytes_checked
+            for bad_entry in file_bad_entries:
+                print(format_bad_entry(bad_entry))
+            bad_entries.extend(file_bad_entries)
+    finally:
+        if jobs != 1:
+            executor.shutdown()
+    elapsed_time = time.perf_counter() - start_time
+    print("Checked {0} files, {1} entries, {2:.1f} MB in {3:.2f}s ({4:.1f} MB/s), {5} bad entries in {6} files.".format(\
+        len(filenames), entries_checked, bytes_checked / 1048576, elapsed_time,\
+        bytes_checked / 1048576 / elapsed_time if elapsed_time > 0 else 0, len(bad_entries), len(set([x[0] for x in bad_entries]))))
+    return(bad_entries)
+
+# Expands folders (to their .pkg and .pka files) and wildcards
+def find_files_to_verify (paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, '*.pkg')) + glob.glob(os.path.join(path, '*.pka'))))
+        elif any(x in path for x in '*?['):
+            filenames.extend(sorted(glob.glob(path)))
+        else:
+            filenames.append(path)
+    return(filenames)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', help="Number of processes (default: one per CPU)", type=int, default=0)
+    parser.add_argument('--stats', help="Report the time and I/O of each stage at the end", action="store_true")
+    parser.add_argument('--stats-json', help="Also save the stats to this .json file")
+    parser.add_argument('files', nargs='+', help=".pkg or .pka files, folders of them, or wildcards such as \"*.pkg\"")
+    args = parser.parse_args()
+    if args.stats or args.stats_json is not None:
+        start_stats(args.stats_json)
+    filenames = find_files_to_verify(args.files)
+    missing_files = [x for x in filenames if not os.path.isfile(x)]
+    if len(missing_files) > 0:
+        raise Exception('Error: {0} not found!'.format(missing_files))
+    bad_entries = verify_files(filenames, args.jobs)
+    sys.exit(1 if len(bad_entries) > 0 else 0)